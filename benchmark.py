@@ -0,0 +1,173 @@
+import os
+import time
+import json
+import argparse
+import resource
+import multiprocessing
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from dm_analyzer import Inbox
+from replay_client import ReplayClient
+from monitor import InstagramMonitor, ThreadChangeTracker
+from user_cache import UserCache
+
+STAGES = ['poll_s', 'fetch_s', 'format_s', 'generate_s', 'send_s']
+
+def echo_responder(context, thread_id=None):
+    """Model-free responder, to measure the pipeline overhead alone."""
+    return context.splitlines()[-1] if context else '?'
+
+def percentiles(values):
+    if len(values) == 0:
+        return {'n': 0, 'p50': None, 'p95': None, 'p99': None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'n': len(values), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+
+def rss_mb():
+    """Current resident set size, falling back to the peak where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_replay(inbox, account_name, responder, thread_titles=None, context_size=20, duration_s=60.0, speed=60.0,
+               poll_interval=1.0, max_poll_interval=5.0, anchor_context=False):
+    """
+    Replays thread_titles of the inbox through InstagramMonitor.poll_and_reply (with anchor_context) for
+    duration_s seconds, always replying, and returns latency percentiles per stage and end to end (from the moment the
+    answered message appeared to the moment the reply was sent), throughput and memory.
+    """
+    client = ReplayClient(inbox, account_name, thread_titles, speed=speed)
+    monitor = InstagramMonitor(account_name, None, client=client, user_cache=UserCache(":memory:"))
+    tracker = ThreadChangeTracker(client, list(client.threads), context_size, poll_interval, max_poll_interval,
+                                  inbox_amount=len(client.threads), user_cache=monitor.users_cache)
+
+    records = []
+    start = time.perf_counter()
+    while True:
+        records.extend(monitor.poll_and_reply(tracker, responder, reply_probability=1.0, verbose=False,
+                                              anchor_context=anchor_context))
+        remaining = duration_s - (time.perf_counter() - start)
+        if remaining <= 0:
+            break
+        time.sleep(min(tracker.seconds_until_next_poll(), remaining))
+    elapsed = time.perf_counter() - start
+
+    replayed = sum(len(thread['visible']) for thread in client.threads.values()) - len(client.sent)
+    # Replies to replayed messages only, not to the account's own messages
+    answers = [sent for sent in client.sent if sent['latency_s'] is not None]
+    return {
+        'context_size': context_size,
+        'stages_ms': {stage: percentiles([record[stage]*1000 for record in records if stage in record]) for stage in STAGES},
+        'end_to_end_ms': percentiles([sent['latency_s']*1000 for sent in answers]),
+        'replies_per_s': len(answers) / elapsed,
+        'messages_per_s': replayed / elapsed,
+        'rss_mb': rss_mb(),
+    }
+
+def _run_backend(model_name, backend, target_name, contexts, max_new_tokens):
+    from instapersona import load_engine
+    before_mb = rss_mb()
+    engine = load_engine(model_name=model_name, target_name=target_name, backend=backend, max_new_tokens=max_new_tokens)
+    model_mb = rss_mb() - before_mb
+    latencies, outputs = [], []
+    for context in contexts:
+        start = time.perf_counter()
+        outputs.append(engine.generate([context])[0])
+        latencies.append(time.perf_counter() - start)
+    return {'backend': backend, 'latency_ms': percentiles([latency*1000 for latency in latencies]),
+            'model_mb': model_mb, 'rss_mb': rss_mb(), 'outputs': outputs}
+
+def compare_backends(model_name, backends, target_name, contexts, max_new_tokens=32):
+    """
+    Generates a reply to each context with every backend (see instapersona.BACKENDS), each in a fresh
+    process so their memory is measured in isolation, and returns per backend the latency percentiles,
+    the memory taken by loading the model, and `agreement`: the fraction of replies identical to those
+    of the first backend.
+    """
+    results = []
+    for backend in backends:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results.append(executor.submit(_run_backend, model_name, backend, target_name, contexts, max_new_tokens).result())
+    reference = results[0]['outputs']
+    for result in results:
+        result['agreement'] = float(np.mean([output == expected for output, expected in zip(result['outputs'], reference)]))
+    return results
+
+def responders(model_name, backends, target_name, max_new_tokens):
+    """
+    Yields (name, responder, anchor_context) for each backend of model_name, loading one engine at a time;
+    anchor_context is whether the responder uses the engine's thread KV cache.
+    """
+    from instapersona import load_engine
+    for backend in backends:
+        engine = load_engine(model_name=model_name, target_name=target_name, backend=backend, max_new_tokens=max_new_tokens)
+        if engine.prefix_cache:
+            yield f"{model_name} [{backend}]", engine.generate_cached, True
+        else:
+            yield f"{model_name} [{backend}]", lambda context, thread_id=None: engine.generate([context])[0], False
+
+def print_result(name, result):
+    print(f"\n== {name} | context_size={result['context_size']} ==")
+    rows = list(result['stages_ms'].items()) + [('end_to_end', result['end_to_end_ms'])]
+    for stage, stats in rows:
+        if stats['n']:
+            print(f"{stage:>12}  n={stats['n']:<5} p50={stats['p50']:9.2f}ms  p95={stats['p95']:9.2f}ms  p99={stats['p99']:9.2f}ms")
+    print(f"{'throughput':>12}  {result['messages_per_s']:.2f} messages/s replayed, {result['replies_per_s']:.2f} replies/s")
+    print(f"{'memory':>12}  {result['rss_mb']:.0f} MB resident")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline latency benchmark of the reply pipeline")
+    parser.add_argument("--inbox", required=True, help="path to the inbox directory of an Instagram export")
+    parser.add_argument("--account", required=True, help="full name of the persona, used as the replying account")
+    parser.add_argument("--threads", nargs="*", help="thread titles to replay (default: the account's 4 largest threads)")
+    parser.add_argument("--models", nargs="+", default=["echo"], help="model names to compare; 'echo' skips the model")
+    parser.add_argument("--backends", nargs="+", default=["hf"], help="inference backends of the models (hf, int8, onnx)")
+    parser.add_argument("--compare-samples", type=int, default=0,
+                        help="also compare the backends of each model on this many contexts of the chat dataset")
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--context-sizes", nargs="+", type=int, default=[10, 20])
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds per run")
+    parser.add_argument("--speed", type=float, default=60.0, help="replay speed-up of the original conversation pace")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    inbox = Inbox(args.inbox)
+    inbox.init_inbox_processing()
+    thread_titles = args.threads or sorted(
+        (dm.title for dm, _ in inbox.participant_rows(args.account)), key=lambda title: -len(inbox.dms[title].messages))[:4]
+
+    results = []
+    for model_name in args.models:
+        runs = [("echo", echo_responder, False)] if model_name == "echo" else responders(model_name, args.backends, args.account,
+                                                                                  args.max_new_tokens)
+        for name, responder, anchor_context in runs:
+            for context_size in args.context_sizes:
+                result = run_replay(inbox, args.account, responder, thread_titles, context_size, args.duration, args.speed,
+                                    anchor_context=anchor_context)
+                result['model'] = name
+                print_result(name, result)
+                results.append(result)
+            
+        if model_name != "echo" and args.compare_samples:
+            contexts = [data_point['context'] for data_point in
+                        islice(inbox.iter_chat_dataset(args.account, max(args.context_sizes)), args.compare_samples)]
+            comparison = compare_backends(model_name, args.backends, args.account, contexts, args.max_new_tokens)
+            print(f"\n== {model_name}: backends on {len(contexts)} contexts ==")
+            for result in comparison:
+                latency = result['latency_ms']
+                print(f"{result['backend']:>12}  p50={latency['p50']:9.2f}ms  p95={latency['p95']:9.2f}ms  "
+                      f"model={result['model_mb']:.0f} MB  agreement={result['agreement']:.0%}")
+                del result['outputs']
+            results.append({'model': model_name, 'backends': comparison})
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
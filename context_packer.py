@@ -0,0 +1,88 @@
+from collections import OrderedDict
+
+class ContextPacker:
+    """
+    Selects the context of a prompt by token budget instead of by message count.
+    Given the formatted lines of the candidate context, oldest first, pack keeps the longest run of most
+    recent lines whose tokens (plus one separator token per line break) fit in token_budget, so the
+    prefill cost of a prompt is bounded and no context is cut off at generation time. The latest line is
+    always kept.
+    Token counts are cached in an LRU of cache_size entries, and the entries missing from it are tokenized
+    in one batch. Lines rendered relative to a reference time change with it, so formatted messages are
+    best counted with count_parts, which caches the count of the invariant part of each message (sender
+    and text) and counts the relative time from a small table; count_tokens caches whole lines.
+    tokenizer is a Hugging Face tokenizer (or any callable returning {'input_ids': [[...], ...]} for a list
+    of texts); picklable if the packer is used with max_workers > 1.
+    """
+    def __init__(self, tokenizer, token_budget=512, cache_size=100_000):
+        self.tokenizer = tokenizer
+        self.token_budget = token_budget
+        self.cache_size = cache_size
+        self._counts = OrderedDict()
+        self._part_counts = OrderedDict()
+        self._suffix_counts = {}
+        self._separator_tokens = None
+
+    def __getstate__(self):
+        # The caches are not worth shipping to worker processes
+        state = self.__dict__.copy()
+        state['_counts'] = OrderedDict()
+        state['_part_counts'] = OrderedDict()
+        state['_suffix_counts'] = {}
+        return state
+
+    def _tokenize(self, texts):
+        return [len(ids) for ids in self.tokenizer(texts, add_special_tokens=False)['input_ids']]
+
+    def _cached_counts(self, cache, keys, text_of):
+        missing = list(dict.fromkeys(key for key in keys if key not in cache))
+        if missing:
+            cache.update(zip(missing, self._tokenize([text_of(key) for key in missing])))
+        counts = []
+        for key in keys:
+            cache.move_to_end(key)
+            counts.append(cache[key])
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return counts
+
+    def count_tokens(self, lines):
+        """Returns the number of tokens of each line."""
+        return self._cached_counts(self._counts, lines, lambda line: line)
+
+    def count_parts(self, parts):
+        """
+        Returns the number of tokens of each formatted message, given as (head, suffix, tail) parts of which
+        only the suffix (a relative time) depends on the reference time. Each distinct head + tail and
+        each distinct suffix is tokenized once. Counting the parts separately never merges tokens across
+        their boundaries, so the counts are in practice equal to or a token above those of the whole lines.
+        """
+        counts = self._cached_counts(self._part_counts, [head + tail for head, _, tail in parts], lambda invariant: invariant)
+        suffixes = [suffix for _, suffix, _ in parts]
+        missing = list(dict.fromkeys(suffix for suffix in suffixes if suffix not in self._suffix_counts))
+        if missing:
+            self._suffix_counts.update(zip(missing, self._tokenize(missing)))
+        return [count + self._suffix_counts[suffix] for count, suffix in zip(counts, suffixes)]
+
+    def pack_start(self, counts, token_budget=None):
+        """Index of the first of the lines with the given token counts that pack keeps."""
+        if self._separator_tokens is None:
+            self._separator_tokens = self._tokenize(['\n'])[0]
+        token_budget = token_budget or self.token_budget
+        total = 0
+        start = len(counts)
+        for count in reversed(counts):
+            total += count + (self._separator_tokens if start < len(counts) else 0)
+            if total > token_budget and start < len(counts):
+                break
+            start -= 1
+        return start
+
+    def pack(self, lines, token_budget=None, counts=None):
+        """
+        Returns the most recent lines (a suffix of lines) that fit in the token budget (or token_budget).
+        counts are the token counts of the lines when already known (see count_parts).
+        """
+        if not lines:
+            return lines
+        return lines[self.pack_start(counts if counts is not None else self.count_tokens(lines), token_budget):]
@@ -0,0 +1,130 @@
+import io
+import os
+import json
+import gzip
+
+FORMATS = ('jsonl', 'parquet')
+COMPRESSIONS = (None, 'gzip', 'zstd')
+
+class ShardedDatasetWriter:
+    """
+    Writes data points to numbered shards as they are produced, e.g. <path_prefix>-00000.jsonl.gz.
+    A shard is written under a .tmp name and renamed once it holds rows_per_shard rows (or the writer is
+    closed), so a consumer listing the directory only ever sees complete shards and can start reading
+    them while generation is still running.
+    JSONL shards are written line by line; Parquet shards (pyarrow) are buffered one shard at a time.
+    zstd compression needs the zstandard package for JSONL.
+    """
+    def __init__(self, path_prefix, format='jsonl', rows_per_shard=100_000, compression=None):
+        if format not in FORMATS:
+            raise ValueError(f'format must be one of {FORMATS}, got {format!r}')
+        if compression not in COMPRESSIONS:
+            raise ValueError(f'compression must be one of {COMPRESSIONS}, got {compression!r}')
+        if rows_per_shard < 1:
+            raise ValueError('rows_per_shard must be at least 1')
+
+        self.path_prefix = path_prefix
+        self.format = format
+        self.rows_per_shard = rows_per_shard
+        self.compression = compression
+        self.shard_paths = []
+        self.rows_written = 0
+
+        self._shard_rows = 0
+        self._file = None
+        self._buffer = []
+        self._closed = False
+
+        directory = os.path.dirname(path_prefix)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if format == 'parquet':
+            _import_pyarrow()
+        elif compression == 'zstd':
+            _import_zstandard()
+
+    def _shard_path(self):
+        extension = self.format
+        if self.format == 'jsonl' and self.compression:
+            extension += '.gz' if self.compression == 'gzip' else '.zst'
+        return f'{self.path_prefix}-{len(self.shard_paths):05d}.{extension}'
+
+    def _open_jsonl(self, path):
+        if self.compression == 'gzip':
+            return gzip.open(path, 'wt', encoding='utf-8')
+        if self.compression == 'zstd':
+            zstandard = _import_zstandard()
+            return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(path, 'wb')), encoding='utf-8')
+        return open(path, 'w', encoding='utf-8')
+
+    def write(self, data_point):
+        if self._closed:
+            raise ValueError('write to a closed ShardedDatasetWriter')
+
+        if self.format == 'jsonl':
+            if self._file is None:
+                self._file = self._open_jsonl(self._shard_path() + '.tmp')
+            self._file.write(json.dumps(data_point) + '\n')
+        else:
+            self._buffer.append(data_point)
+
+        self._shard_rows += 1
+        self.rows_written += 1
+        if self._shard_rows >= self.rows_per_shard:
+            self._finish_shard()
+
+    def _finish_shard(self):
+        if self._shard_rows == 0:
+            return
+        path = self._shard_path()
+        if self.format == 'jsonl':
+            self._file.close()
+            self._file = None
+        else:
+            pa, pq = _import_pyarrow()
+            pq.write_table(pa.Table.from_pylist(self._buffer), path + '.tmp', compression=self.compression or 'none')
+            self._buffer = []
+        os.replace(path + '.tmp', path)
+        self.shard_paths.append(path)
+        self._shard_rows = 0
+
+    def stream(self, data_points):
+        """Lazily writes data_points, yielding each one once it has been written. Closes the writer at the end."""
+        try:
+            for data_point in data_points:
+                self.write(data_point)
+                yield data_point
+        finally:
+            self.close()
+
+    def write_all(self, data_points):
+        for _ in self.stream(data_points):
+            pass
+        return self.shard_paths
+
+    def close(self):
+        if self._closed:
+            return
+        self._finish_shard()
+        self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError('Parquet shards require pyarrow (pip install pyarrow)') from e
+    return pa, pq
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError('zstd compressed JSONL shards require zstandard (pip install zstandard)') from e
+    return zstandard
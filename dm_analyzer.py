@@ -1,28 +1,156 @@
+import os
 import re
 import json
 import matplotlib.pyplot as plt
 from datetime import datetime
-from collections import Counter, deque
+from zoneinfo import ZoneInfo
+from enum import Enum
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import pickle
+import zlib
 
+import numpy as np
 from tqdm import tqdm
-import random
-random.seed(1)
 
-from helper import get_file_dir_with_ext, get_file_dir_from_dir, transcoder
+from helper import get_file_dir_with_ext, get_file_dir_from_dir, transcoder, iter_json_fields
+from text_stats import TextStats, normalize_text
+
+CACHE_VERSION = 2
+
+# Bits of the per-message flags column of MessageStore
+FLAG_HAS_TEXT = 1
+FLAG_IS_MESSAGE = 2
+FLAG_ATTACHMENT = 4
+FLAG_REACTION = 8
+FLAG_ACTION = 16
+
+class MessageCategory(Enum):
+    TEXT = 0
+    ATTACHMENT = 1
+    REACTION = 2
+    ACTION = 3
+
+DEFAULT_SYSTEM_PATTERNS = [
+    (MessageCategory.ATTACHMENT, r'.*sent an attachment.'),
+    # Exclude messages like "user_name reacted \u00e2\u0098\u00a0\u00ef\u00b8\u008f to your message " and "Reacted 🧡 to your message "
+    (MessageCategory.REACTION, r'.* reacted.*to your message '),
+    (MessageCategory.REACTION, r'Reacted.*to your message '),
+    (MessageCategory.REACTION, r'.*liked a message'),
+    (MessageCategory.REACTION, r'Liked by .*'),
+    # Katherine created the group.
+    (MessageCategory.ACTION, r'.* started an audio call'),
+    (MessageCategory.ACTION, r'You missed an audio call'),
+    (MessageCategory.ACTION, r'.* started a video chat'),
+    (MessageCategory.ACTION, r'You missed a video chat'),
+    (MessageCategory.ACTION, r'.* created the group'),
+]
+
+class MessageClassifier:
+    """
+    Classifies message text as plain text or a system message (attachment, reaction, action).
+    Consecutive patterns are compiled into a single alternation matched once from the start of the text;
+    patterns that cannot be combined (groups, which backreferences could point to, or global inline
+    flags) are matched on their own. When several patterns match, the one registered first wins.
+    """
+    # Flags a pattern can carry into its own scoped group of the alternation
+    _SCOPED_FLAGS = ((re.IGNORECASE, 'i'), (re.MULTILINE, 'm'), (re.DOTALL, 's'), (re.VERBOSE, 'x'), (re.ASCII, 'a'))
+    
+    def __init__(self, patterns=DEFAULT_SYSTEM_PATTERNS):
+        self.patterns = []
+        self._matchers = None
+        for category, pattern in patterns:
+            self.register(pattern, category)
+            
+    def register(self, pattern, category):
+        """Adds a system message pattern (a string or compiled pattern), e.g. the wording used by another locale."""
+        category = MessageCategory(category)
+        compiled = re.compile(pattern)
+        if not isinstance(compiled.pattern, str):
+            raise TypeError('System message patterns must be str patterns')
+        self.patterns.append((category, compiled, self._scoped(compiled)))
+        self._matchers = None
+        
+    @classmethod
+    def _scoped(cls, compiled):
+        """The pattern as a scoped-flag group that can join the alternation, or None if it has to be matched alone."""
+        if compiled.groups:
+            return None
+        flags = ''.join(letter for flag, letter in cls._SCOPED_FLAGS if compiled.flags & flag)
+        scoped = f'(?{flags}:{compiled.pattern})' if flags else f'(?:{compiled.pattern})'
+        try:
+            re.compile(scoped)
+        except re.error:
+            # e.g. global inline flags such as (?i) at the start of the pattern
+            return None
+        return scoped
+        
+    def _compile(self):
+        # [(regex, {group index: category} of an alternation, or the category of a lone pattern)], tried in order
+        self._matchers = []
+        run = []
+        for category, compiled, scoped in self.patterns + [(None, None, None)]:
+            if scoped is not None:
+                run.append((category, scoped))
+                continue
+            if run:
+                regex = re.compile('|'.join(f'({scoped})' for _, scoped in run))
+                self._matchers.append((regex, {i + 1: category for i, (category, _) in enumerate(run)}))
+                run = []
+            if compiled is not None:
+                self._matchers.append((compiled, category))
+        
+    def classify(self, text):
+        if self._matchers is None:
+            self._compile()
+        for regex, categories in self._matchers:
+            match = regex.match(text)
+            if match:
+                if isinstance(categories, MessageCategory):
+                    return categories
+                # lastindex is the outermost group that closed last, i.e. the alternative that matched
+                return categories[match.lastindex]
+        return MessageCategory.TEXT
+    
+    def fingerprint(self):
+        return [[category.name, compiled.pattern, compiled.flags] for category, compiled, _ in self.patterns]
+
+MESSAGE_CLASSIFIER = MessageClassifier()
+
+def register_system_pattern(pattern, category):
+    MESSAGE_CLASSIFIER.register(pattern, category)
 
 class Content:
+        __slots__ = ('text', 'photos', 'share', 'links', 'is_message')
+        
         def __init__(self, json_message):
             self.text = transcoder(json_message['content']) if 'content' in json_message else None
-            self.photos = json_message['photos'] if 'photos' in json_message else None
-            self.share = json_message['share'] if 'share' in json_message else None
+            self._set_attachments(json_message['photos'] if 'photos' in json_message else None,
+                                  json_message['share'] if 'share' in json_message else None)
+            
+        def _set_attachments(self, photos, share):
+            self.photos = photos
+            self.share = share
             self.links = self.share['link'] if self.share and 'link' in self.share else None
             self.is_message = True if isinstance(self.text, str) and not self.photos and not self.share else False
+            
+        @classmethod
+        def from_record(cls, text, photos=None, share=None):
+            content = cls.__new__(cls)
+            content.text = text
+            content._set_attachments(photos, share)
+            return content
 
 class Message:
+    __slots__ = ('sender_name', 'timestamp_ms', 'epoch_time', 'content', 
+                 'is_attachment_message', 'is_reaction_message', 'is_action_message')
+    
     def __init__(self, json_message):
         self.sender_name = transcoder(json_message['sender_name'])
-        self.epoch_time = json_message['timestamp_ms']/1000
-        self.datetime = datetime.fromtimestamp(self.epoch_time)
+        self.timestamp_ms = json_message['timestamp_ms']
+        self.epoch_time = self.timestamp_ms/1000
         self.content = Content(json_message)
         
         self.is_attachment_message = True
@@ -30,43 +158,35 @@ class Message:
         self.is_action_message = False
         
         if self.content.text:
-            self.is_attachment_message = self._is_attachment_message(self.content.text)
-            self.is_reaction_message = self._is_reaction_message(self.content.text)
-            self.is_action_message = self._is_action_message(self.content.text)
-        
-    def _is_attachment_message(self, content):
-        patterns = [
-            re.compile(r'.*sent an attachment.'),
-        ]
-        if any([pattern.match(content) for pattern in patterns]):
-            return True
-        return False
-        
-    def _is_reaction_message(self, content):
-        # Exclude messages like "user_name reacted \u00e2\u0098\u00a0\u00ef\u00b8\u008f to your message " and "Reacted 🧡 to your message "        
-        patterns = [
-            re.compile(r'.* reacted.*to your message '),
-            re.compile(r'Reacted.*to your message '),
-            re.compile(r'.*liked a message'),
-            re.compile(r'Liked by .*'),
-        ]
-        if any([pattern.match(content) for pattern in patterns]):
-            return True
-        return False
+            category = MESSAGE_CLASSIFIER.classify(self.content.text)
+            self.is_attachment_message = category is MessageCategory.ATTACHMENT
+            self.is_reaction_message = category is MessageCategory.REACTION
+            self.is_action_message = category is MessageCategory.ACTION
+        
+    @classmethod
+    def from_record(cls, sender_name, timestamp_ms, text, flags, photos=None, share=None):
+        """Rebuilds a message from its stored columns without re-running the transcoder or the regexes."""
+        message = cls.__new__(cls)
+        message.sender_name = sender_name
+        message.timestamp_ms = timestamp_ms
+        message.epoch_time = timestamp_ms/1000
+        message.content = Content.from_record(text, photos, share)
+        message.is_attachment_message = bool(flags & FLAG_ATTACHMENT)
+        message.is_reaction_message = bool(flags & FLAG_REACTION)
+        message.is_action_message = bool(flags & FLAG_ACTION)
+        return message
     
-    def _is_action_message(self, content):
-        # Katherine created the group.
-        patterns = [
-            re.compile(r'.* started an audio call'),
-            re.compile(r'You missed an audio call'),
-            re.compile(r'.* started a video chat'),
-            re.compile(r'You missed a video chat'),
-            re.compile(r'.* created the group'),            
-        ]
-        if any([pattern.match(content) for pattern in patterns]):
-            return True
-        return False
+    @property
+    def datetime(self):
+        return datetime.fromtimestamp(self.epoch_time)
     
+    def get_flags(self):
+        return ((FLAG_HAS_TEXT if self.content.text is not None else 0)
+                | (FLAG_IS_MESSAGE if self.content.is_message else 0)
+                | (FLAG_ATTACHMENT if self.is_attachment_message else 0)
+                | (FLAG_REACTION if self.is_reaction_message else 0)
+                | (FLAG_ACTION if self.is_action_message else 0))
+        
     def get_string(self, base_time=None):
         if not base_time:
             return f'{self.sender_name}: {self.content.text}'
@@ -77,6 +197,131 @@ class Message:
         return f'''{self.sender_name} ({self.datetime.strftime('%Y-%m-%d %H:%M:%S')}): {self.content.text}\n'''
         
 
+class MessageStore:
+    """
+    Struct-of-arrays storage of the messages of one conversation, oldest first.
+    Senders are interned into a per-store table and referenced by id, timestamps are int64 milliseconds
+    and the message type booleans are packed into a uint8 bitfield (FLAG_*). Photos and shares, which
+    few messages carry, live in a sparse row -> (photos, share) dict.
+    Indexing is O(1) and returns a Message view built on the fly from the row; views are plain
+    copies, so modifying one does not modify the store.
+    """
+    def __init__(self, senders=None, sender_ids=None, timestamps_ms=None, flags=None, texts=None, extras=None):
+        self.senders = list(senders) if senders else []
+        self._sender_lookup = {sender: i for i, sender in enumerate(self.senders)}
+        self.sender_ids = np.asarray(sender_ids if sender_ids is not None else [], dtype=np.int32)
+        self.timestamps_ms = np.asarray(timestamps_ms if timestamps_ms is not None else [], dtype=np.int64)
+        self.flags = np.asarray(flags if flags is not None else [], dtype=np.uint8)
+        self.texts = texts if texts is not None else []
+        self.extras = extras if extras is not None else {}
+        
+    @classmethod
+    def from_messages(cls, messages, newest_first=False):
+        store = cls()
+        store.extend(messages, newest_first)
+        return store
+    
+    def intern_sender(self, sender_name):
+        sender_id = self._sender_lookup.get(sender_name)
+        if sender_id is None:
+            sender_id = self._sender_lookup[sender_name] = len(self.senders)
+            self.senders.append(sender_name)
+        return sender_id
+    
+    def sender_id(self, sender_name):
+        """Returns the id of sender_name in this store, or -1 if they never sent a message here."""
+        return self._sender_lookup.get(sender_name, -1)
+    
+    def extend(self, messages, newest_first=False):
+        """Appends messages that are newer than every stored message."""
+        sender_ids, timestamps, flags, texts, extras = array('i'), array('q'), array('B'), [], {}
+        for i, message in enumerate(messages):
+            sender_ids.append(self.intern_sender(message.sender_name))
+            timestamps.append(message.timestamp_ms)
+            flags.append(message.get_flags())
+            texts.append(message.content.text)
+            if message.content.photos or message.content.share:
+                extras[i] = (message.content.photos, message.content.share)
+                
+        n = len(texts)
+        new_sender_ids = np.frombuffer(sender_ids, dtype=np.int32) if n else np.zeros(0, np.int32)
+        new_timestamps = np.frombuffer(timestamps, dtype=np.int64) if n else np.zeros(0, np.int64)
+        new_flags = np.frombuffer(flags, dtype=np.uint8) if n else np.zeros(0, np.uint8)
+        if newest_first:
+            new_sender_ids, new_timestamps, new_flags = new_sender_ids[::-1], new_timestamps[::-1], new_flags[::-1]
+            texts.reverse()
+            extras = {n - 1 - i: extra for i, extra in extras.items()}
+            
+        offset = len(self)
+        self.sender_ids = np.concatenate([self.sender_ids, new_sender_ids])
+        self.timestamps_ms = np.concatenate([self.timestamps_ms, new_timestamps])
+        self.flags = np.concatenate([self.flags, new_flags])
+        self.texts.extend(texts)
+        self.extras.update({offset + i: extra for i, extra in extras.items()})
+        
+    def take(self, rows):
+        """Returns a new store holding the given rows (an index array or boolean mask), in order."""
+        rows = np.arange(len(self))[rows] if np.asarray(rows).dtype == bool else np.asarray(rows, dtype=np.int64)
+        new_rows = {int(row): i for i, row in enumerate(rows)}
+        return MessageStore(self.senders, self.sender_ids[rows], self.timestamps_ms[rows], self.flags[rows],
+                            [self.texts[row] for row in rows],
+                            {new_rows[row]: extra for row, extra in self.extras.items() if row in new_rows})
+    
+    def filter(self, message_filter):
+        return self.take(np.fromiter((bool(message_filter(message)) for message in self), dtype=bool, count=len(self)))
+        
+    def _view(self, i):
+        photos, share = self.extras.get(i, (None, None))
+        return Message.from_record(self.senders[self.sender_ids[i]], int(self.timestamps_ms[i]), self.texts[i], 
+                                   int(self.flags[i]), photos, share)
+    
+    def __len__(self):
+        return len(self.texts)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._view(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('message index out of range')
+        return self._view(index)
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._view(i)
+            
+    def save(self, path):
+        """Writes the columns as .npy files plus a utf-8 text blob addressed by text_offsets.npy."""
+        text_offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        with open(os.path.join(path, 'text.bin'), 'wb') as text_file:
+            for i, text in enumerate(self.texts):
+                encoded = text.encode('utf-8') if text else b''
+                text_file.write(encoded)
+                text_offsets[i+1] = text_offsets[i] + len(encoded)
+        np.save(os.path.join(path, 'sender_ids.npy'), self.sender_ids)
+        np.save(os.path.join(path, 'timestamps_ms.npy'), self.timestamps_ms)
+        np.save(os.path.join(path, 'flags.npy'), self.flags)
+        np.save(os.path.join(path, 'text_offsets.npy'), text_offsets)
+        
+    @classmethod
+    def load(cls, path, senders, extras):
+        """Memory-maps the columns written by save."""
+        sender_ids = np.load(os.path.join(path, 'sender_ids.npy'), mmap_mode='r')
+        timestamps_ms = np.load(os.path.join(path, 'timestamps_ms.npy'), mmap_mode='r')
+        flags = np.load(os.path.join(path, 'flags.npy'), mmap_mode='r')
+        text_offsets = np.load(os.path.join(path, 'text_offsets.npy'), mmap_mode='r').tolist()
+        with open(os.path.join(path, 'text.bin'), 'rb') as file:
+            text_blob = file.read()
+        has_text = (flags & FLAG_HAS_TEXT).astype(bool).tolist()
+        texts = [text_blob[text_offsets[i]:text_offsets[i+1]].decode('utf-8') if has_text[i] else None 
+                 for i in range(len(has_text))]
+        return cls(senders, sender_ids, timestamps_ms, flags, texts, extras)
+    
+    def __repr__(self):
+        return f'MessageStore({len(self)} messages, {len(self.senders)} senders)'
+        
+
 class DirectMessages:
     def __init__(self, dm_dir):
         self.dm_dir = dm_dir
@@ -84,232 +329,698 @@ class DirectMessages:
         self.title = None
         self.participants = None
         self.is_gc = None
-        self.messages = deque()
+        self.messages = MessageStore()
+        # Bookkeeping for refresh(): source files as of the last load, newest timestamp seen before
+        # filtering, and the first row appended by the last load/refresh
+        self.signature = None
+        self.latest_timestamp_ms = None
+        self.new_messages_start = 0
+        
+    @classmethod
+    def from_store(cls, dm_dir, title, participants, store):
+        """
+        A conversation whose messages are already in a MessageStore (e.g. read from an InboxArchive)
+        rather than parsed from the export. dm_dir is only recorded; it does not have to exist.
+        """
+        dm = cls.__new__(cls)
+        dm.dm_dir = dm_dir
+        dm.dm_json_files = []
+        dm.title = title
+        dm.participants = participants
+        dm.is_gc = len(participants) > 2
+        dm.messages = store
+        dm.signature = None
+        dm.latest_timestamp_ms = int(store.timestamps_ms[-1]) if len(store) else None
+        dm.new_messages_start = 0
+        return dm
         
     def _message_filter_default(self, message):
         return message
+    
+    def _set_metadata(self, key, value):
+        if key == 'title':
+            self.title = transcoder(value)
+        elif key == 'participants':
+            self.participants = [transcoder(participant['name']) for participant in value]
+            self.is_gc = len(self.participants) > 2
         
-    def init_dm_processing(self, message_filer=_message_filter_default):
+    def iter_messages(self, message_filter=None, since_ms=None):
+        """
+        Streams the messages of the conversation one at a time, newest first (the export order).
+        The JSON files are parsed incrementally, so only the message being yielded is held in memory
+        and messages rejected by message_filter are dropped as soon as they are parsed.
+        With since_ms, parsing stops at the first message that is not newer than since_ms.
+        The title and participants are filled in from the first file as they are read.
+        """
+        if message_filter is None:
+            message_filter = self._message_filter_default
+            
         for i, json_path in tqdm(enumerate(self.dm_json_files), desc='Processing JSON files', leave=False):
-            with open(json_path, 'r') as file:
-                json_data = json.load(file)  
-                
-            for json_message in json_data['messages']:
-                message = Message(json_message)
-                if message_filer(message):
-                    self.messages.appendleft(message)
+            for key, value in iter_json_fields(json_path, 'messages'):
+                if key == 'messages':
+                    if since_ms is not None and value['timestamp_ms'] <= since_ms:
+                        return
+                    if self.latest_timestamp_ms is None or value['timestamp_ms'] > self.latest_timestamp_ms:
+                        self.latest_timestamp_ms = value['timestamp_ms']
+                    message = Message(value)
+                    if message_filter(message):
+                        yield message
+                elif i == 0:
+                    self._set_metadata(key, value)
+        
+    def init_dm_processing(self, message_filer=None):
+        self.signature = self._source_signature()
+        self.messages = MessageStore.from_messages(self.iter_messages(message_filer), newest_first=True)
+        self.new_messages_start = 0
+        
+    def refresh(self, message_filter=None):
+        """
+        Appends the messages added to the export since the conversation was loaded and returns their number.
+        Nothing is parsed if no message_N.json changed size or mtime; otherwise the files are streamed
+        newest first and parsing stops at the newest message already seen, so only the delta is read.
+        Messages sharing the exact timestamp of that message are considered already seen.
+        """
+        self.dm_json_files = get_file_dir_with_ext(self.dm_dir, 'json')
+        signature = self._source_signature()
+        self.new_messages_start = len(self.messages)
+        if signature == self.signature:
+            return 0
+        
+        self.signature = signature
+        self.messages.extend(self.iter_messages(message_filter, since_ms=self.latest_timestamp_ms), newest_first=True)
+        return len(self.messages) - self.new_messages_start
             
-            if i == 0:
-                self.title = transcoder(json_data['title'])
-                self.participants = [transcoder(participant['name']) for participant in json_data['participants']]
-                self.is_gc = len(self.participants) > 2
+    def _source_signature(self):
+        signature = []
+        for json_path in self.dm_json_files:
+            stat = os.stat(json_path)
+            signature.append([os.path.basename(json_path), stat.st_mtime_ns, stat.st_size])
+        return signature
+            
+    def save_cache(self, cache_path):
+        """
+        Parses the conversation (unfiltered) and writes its MessageStore columns to a cache directory.
+        meta.json is written last and records the size and mtime of every source file, so a cache is
+        only used while the export is unchanged.
+        """
+        os.makedirs(cache_path, exist_ok=True)
+        store = MessageStore.from_messages(self.iter_messages(), newest_first=True)
+        store.save(cache_path)
+        
+        meta = {
+            'version': CACHE_VERSION,
+            'signature': self._source_signature(),
+            'classifier': MESSAGE_CLASSIFIER.fingerprint(),
+            'title': self.title,
+            'participants': self.participants,
+            'senders': store.senders,
+            'extras': [[row, photos, share] for row, (photos, share) in store.extras.items()],
+        }
+        with open(os.path.join(cache_path, 'meta.json.tmp'), 'w') as file:
+            json.dump(meta, file)
+        os.replace(os.path.join(cache_path, 'meta.json.tmp'), os.path.join(cache_path, 'meta.json'))
+        
+    def load_cache(self, cache_path, message_filter=None):
+        """
+        Loads the conversation from a cache written by save_cache, memory-mapping its columns.
+        Returns False, leaving the conversation untouched, if there is no cache or it is stale.
+        """
+        meta_path = os.path.join(cache_path, 'meta.json')
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path, 'r') as file:
+            meta = json.load(file)
+        if (meta.get('version') != CACHE_VERSION or meta['signature'] != self._source_signature()
+                or meta['classifier'] != MESSAGE_CLASSIFIER.fingerprint()):
+            return False
+        
+        extras = {row: (photos, share) for row, photos, share in meta['extras']}
+        self.messages = MessageStore.load(cache_path, meta['senders'], extras)
+        self.signature = meta['signature']
+        self.latest_timestamp_ms = int(self.messages.timestamps_ms.max()) if len(self.messages) else None
+        self.new_messages_start = 0
+        if message_filter is not None:
+            self.messages = self.messages.filter(message_filter)
+        self.title = meta['title']
+        self.participants = meta['participants']
+        self.is_gc = len(self.participants) > 2
+        return True
                 
     def __repr__(self):
         return f'{self.title} ({self.participants})'
 
+def text_message_filter(message):
+    """Keeps plain text messages, dropping attachments, shares, reactions and call/group notices."""
+    return (message.content.is_message and not message.is_attachment_message 
+            and not message.is_reaction_message and not message.is_action_message)
+
+def _load_dm(dm_dir, message_filter=None, cache_dir=None):
+    # Module level so that it can be shipped to worker processes
+    dm = DirectMessages(dm_dir)
+    if cache_dir is None:
+        dm.init_dm_processing(message_filter)
+        return dm
+    
+    cache_path = os.path.join(cache_dir, os.path.basename(dm_dir))
+    if not dm.load_cache(cache_path, message_filter):
+        dm.save_cache(cache_path)
+        dm.load_cache(cache_path, message_filter)
+    return dm
+
+def _check_picklable(obj, name, option):
+    try:
+        pickle.dumps(obj)
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        raise ValueError(f'{name} must be picklable when {option} > 1 '
+                         f'(use a module level function or functools.partial instead of a lambda): {e}')
+
+def default_message_format(message: Message, ref_datetime: datetime) -> str:
+    return str(message)
+
+def _iter_chat_data_points(dm, target_rows, context_size, message_format, time_bucket=None, start=0, packer=None):
+    """
+    Yields the chat data points of one conversation, visiting only the rows sent by the target (target_rows,
+    from the participant index) and the context_size rows preceding each of them.
+    Every context message is formatted at most once per reference time: the timestamp of the target's
+    message, rounded down to time_bucket seconds when given, so consecutive replies in one bucket reuse
+    the formatted lines. A message_format with a window_parts method (see formatting.RelativeTimeFormat)
+    formats each context as a whole instead. Only responses at or after row start are emitted.
+    With a ContextPacker, the context is the most recent of those lines that fit its token budget.
+    """
+    store = dm.messages
+    window_parts = getattr(message_format, 'window_parts', None)
+    formatted = {}
+    ref_ms = None
+    for i in target_rows[target_rows >= start].tolist():
+        timestamp_ms = int(store.timestamps_ms[i])
+        bucket_ms = timestamp_ms - timestamp_ms % (time_bucket*1000) if time_bucket else timestamp_ms
+        if bucket_ms != ref_ms:
+            ref_ms = bucket_ms
+            ref_datetime = datetime.fromtimestamp(ref_ms/1000)
+            formatted.clear()
+        
+        window_start = max(0, i - context_size)
+        if window_parts is not None:
+            context = _pack_window(window_parts(store, range(window_start, i), ref_ms), packer)
+        else:
+            # Rows are inserted in increasing order, so the ones that left the window come first
+            while formatted and next(iter(formatted)) < window_start:
+                del formatted[next(iter(formatted))]
+                
+            context = []
+            for j in range(window_start, i):
+                line = formatted.get(j)
+                if line is None:
+                    line = formatted[j] = message_format(store[j], ref_datetime)
+                context.append(line)
+            if packer is not None:
+                context = packer.pack(context)
+            
+        yield {
+            'context': '\n'.join(context),
+            'response': store.texts[i]
+        }
+
+def _pack_window(parts, packer=None):
+    """Lines of (head, suffix, tail) parts, packed by packer if any."""
+    lines = [head + suffix + tail for head, suffix, tail in parts]
+    if packer is None:
+        return lines
+    return packer.pack(lines, counts=packer.count_parts(parts))
+
+def _chat_data_points(*args):
+    return list(_iter_chat_data_points(*args))
+
+def _timing_windows(is_target, timestamps_ms, context_size, window_seconds=None):
+    """
+    Finds the windows of a conversation where the target is active, as runs of target messages whose
+    consecutive gaps are at most context_size messages (or window_seconds seconds). Returns the target
+    rows of every window and the first and last row of each window, which start context_size messages
+    before its first target message and end context_size messages (or window_seconds) after its last one.
+    """
+    targets = np.flatnonzero(is_target)
+    if len(targets) == 0:
+        return [], np.zeros(0, np.int64), np.zeros(0, np.int64)
+    if window_seconds is None:
+        breaks = np.flatnonzero(np.diff(targets) > context_size) + 1
+    else:
+        breaks = np.flatnonzero(np.diff(timestamps_ms[targets]) > window_seconds*1000) + 1
+    target_groups = np.split(targets, breaks)
+    firsts = targets[np.r_[0, breaks]]
+    lasts = targets[np.r_[breaks - 1, len(targets) - 1]]
+    
+    starts = np.maximum(firsts - context_size, 0)
+    if window_seconds is None:
+        ends = np.minimum(lasts + context_size, len(is_target) - 1)
+    else:
+        # Exports are chronological, but equal or slightly unordered timestamps must not break the search
+        sorted_ms = np.maximum.accumulate(timestamps_ms)
+        ends = np.searchsorted(sorted_ms, sorted_ms[lasts] + window_seconds*1000, side='right') - 1
+    return target_groups, starts, ends
+
+def _iter_timing_data_points(dm, target_participant, context_size, message_format, start=0, packer=None,
+                             window_seconds=None, seed=1):
+    """
+    Yields the timing data points of one conversation (see Inbox.iter_timing_dataset): per window, the
+    sampled negatives then the target's messages, each with the context_size messages before it in the
+    window, formatted relative to its time. Only data points at or after row start are emitted.
+    """
+    store = dm.messages
+    is_target = store.sender_ids == store.sender_id(target_participant)
+    target_groups, starts, ends = _timing_windows(is_target, store.timestamps_ms, context_size, window_seconds)
+    # Seeded per conversation, so the samples do not depend on the order conversations are processed in
+    rng = np.random.default_rng([seed, zlib.crc32(dm.title.encode())])
+    
+    window_parts = getattr(message_format, 'window_parts', None)
+    
+    def data_point(row, window_start, label):
+        ref_ms = int(store.timestamps_ms[row])
+        context_rows = range(max(window_start, row - context_size), row)
+        if window_parts is not None:
+            context = _pack_window(window_parts(store, context_rows, ref_ms), packer)
+        else:
+            ref_datetime = datetime.fromtimestamp(ref_ms/1000)
+            context = [message_format(store[j], ref_datetime) for j in context_rows]
+            if packer is not None:
+                context = packer.pack(context)
+        return {'context': '\n'.join(context), 'label': label}
+    
+    for targets, window_start, window_end in zip(target_groups, starts.tolist(), ends.tolist()):
+        candidates = np.arange(window_start + context_size + 1, window_end + 1)
+        candidates = candidates[~is_target[candidates]]
+        if len(targets) > len(candidates):
+            continue
+        negatives = np.sort(rng.choice(candidates, len(targets), replace=False))
+        
+        for row in negatives.tolist():
+            if row >= start:
+                yield data_point(row, window_start, 0)
+        for row in targets.tolist():
+            if row >= start:
+                yield data_point(row, window_start, 1)
+
+def _timing_data_points(*args):
+    return list(_iter_timing_data_points(*args))
+
+def _local_hours_and_weekdays(timestamps_ms, tz=None):
+    """
+    Vectorised local hour of day (0-23) and weekday (0 = Monday) of epoch millisecond timestamps.
+    tz is a tzinfo, an IANA name such as 'Europe/London', or None for the system timezone.
+    UTC offsets are only looked up once per distinct UTC hour, which keeps DST changes exact.
+    """
+    if isinstance(tz, str):
+        tz = ZoneInfo(tz)
+    timestamps_ms = np.asarray(timestamps_ms, dtype=np.int64)
+    utc_hours, inverse = np.unique(timestamps_ms // 3_600_000, return_inverse=True)
+    offsets_ms = np.array([
+        (datetime.fromtimestamp(int(hour)*3600, tz) if tz else datetime.fromtimestamp(int(hour)*3600).astimezone())
+        .utcoffset().total_seconds()*1000 for hour in utc_hours
+    ], dtype=np.int64)
+    local_ms = timestamps_ms + offsets_ms[inverse].reshape(timestamps_ms.shape)
+    hours = (local_ms // 3_600_000) % 24
+    # 1970-01-01 was a Thursday
+    weekdays = (local_ms // 86_400_000 + 3) % 7
+    return hours, weekdays
+
 class Inbox:
-    def __init__(self, inbox_dir):
+    def __init__(self, inbox_dir, cache_dir=None):
         self.inbox_dir = inbox_dir
-        self.dm_dirs = get_file_dir_from_dir(inbox_dir)
+        self.cache_dir = cache_dir
+        self.dm_dirs = get_file_dir_from_dir(inbox_dir) if inbox_dir is not None else []
         self.dms = {}
         self.all_participants = set()
+        # Remembered by init_inbox_processing so refresh() loads new data the same way
+        self.dm_filter = None
+        self.message_filter = None
+        self.rejected_dm_dirs = set()
+        # Directories of conversations replaced in self.dms by a later one with the same title (e.g.
+        # several deleted accounts all titled 'Instagram User'); the later one wins, as on a full load
+        self.shadowed_dm_dirs = set()
+        # participant -> {dm title: rows of the dm's MessageStore sent by the participant}, in self.dms order
+        self.participant_index = {}
+        self._indexed_participants = {}
+        # Conversations merged with index=False, indexed on first use: title -> dm, in self.dms order
+        self._unindexed_dms = {}
+        # Set by open_mmap
+        self.archive = None
+        
+    @classmethod
+    def open_mmap(cls, path, titles=None, participants=None, since=None, until=None, check_classifier=True):
+        """
+        Opens an archive written by save_archive without parsing it, materialising only the conversations (and
+        messages) selected by titles, participants and [since, until). The inbox cannot be refreshed.
+        """
+        from inbox_archive import InboxArchive
+        archive = InboxArchive(path, check_classifier)
+        selected = archive.titles()
+        if titles is not None:
+            titles = set(titles)
+            selected = [title for title in selected if title in titles]
+        if participants is not None:
+            with_participants = set().union(*(archive.titles_with(participant) for participant in participants))
+            selected = [title for title in selected if title in with_participants]
+        if since is not None or until is not None:
+            in_range = set(archive.titles_between(since, until))
+            selected = [title for title in selected if title in in_range]
+        
+        inbox = cls(None)
+        inbox.archive = archive
+        inbox._merge_dms((archive.dm(title, since, until) for title in selected), inbox._dm_default_filer, index=False)
+        return inbox
+        
+    def save_archive(self, path):
+        """Writes the loaded conversations to a single memory-mappable archive file (see open_mmap)."""
+        from inbox_archive import write_archive
+        write_archive(self, path)
         
     def _dm_default_filer(self, dm):
         return dm
     
-    def init_inbox_processing(self, dm_filter=_dm_default_filer, message_filter=None):
-        for dm_dir in tqdm(self.dm_dirs, desc='Processing Inbox', leave=True):
-            dm = DirectMessages(dm_dir)
-            dm.init_dm_processing(message_filter) if message_filter else dm.init_dm_processing()
+    def init_inbox_processing(self, dm_filter=None, message_filter=None, workers=None):
+        """
+        Loads every conversation of the inbox.
+        If the inbox has a cache_dir, each conversation is loaded from its columnar cache when the
+        cache is still valid, and (re)parsed and cached otherwise.
+        With workers > 1 the conversation directories are parsed in a process pool; results are still
+        merged in directory order so the outcome is identical to a serial load. message_filter is sent
+        to the workers and must therefore be picklable (a module level function such as
+        text_message_filter or a functools.partial of one, not a lambda). dm_filter runs in this process.
+        """
+        if dm_filter is None:
+            dm_filter = self._dm_default_filer
+        self.dm_filter = dm_filter
+        self.message_filter = message_filter
+            
+        if workers and workers > 1:
+            _check_picklable(message_filter, 'message_filter', 'workers')
+            
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                chunksize = max(1, len(self.dm_dirs) // (workers * 4))
+                dms = executor.map(_load_dm, self.dm_dirs, repeat(message_filter), repeat(self.cache_dir), chunksize=chunksize)
+                self._merge_dms(tqdm(dms, total=len(self.dm_dirs), desc='Processing Inbox', leave=True), dm_filter)
+        else:
+            dms = (_load_dm(dm_dir, message_filter, self.cache_dir) for dm_dir in self.dm_dirs)
+            self._merge_dms(tqdm(dms, total=len(self.dm_dirs), desc='Processing Inbox', leave=True), dm_filter)
+            
+    def _merge_dms(self, dms, dm_filter, index=True):
+        for dm in dms:
             if dm_filter(dm):
+                previous = self.dms.get(dm.title)
+                if previous is not None and previous.dm_dir != dm.dm_dir:
+                    self.shadowed_dm_dirs.add(previous.dm_dir)
                 self.dms[dm.title] = dm
                 self.all_participants.update(dm.participants)
+                if index:
+                    self._index_dm(dm)
+                else:
+                    self._unindexed_dms[dm.title] = dm
+            else:
+                self.rejected_dm_dirs.add(dm.dm_dir)
                 
-    def __repr__(self):
-        return f'{self.dms.keys()}'
+    def _index_dm(self, dm):
+        """(Re)indexes the rows sent by each participant of dm, keeping the dm's position in the index."""
+        store = dm.messages
+        order = np.argsort(store.sender_ids, kind='stable')
+        bounds = np.searchsorted(store.sender_ids[order], np.arange(len(store.senders) + 1))
+        participants = set(dm.participants)
+        for participant in self._indexed_participants.get(dm.title, set()) - participants:
+            del self.participant_index[participant][dm.title]
+        for participant in participants:
+            sender_id = store.sender_id(participant)
+            rows = order[bounds[sender_id]:bounds[sender_id+1]] if sender_id >= 0 else np.zeros(0, dtype=np.int64)
+            self.participant_index.setdefault(participant, {})[dm.title] = rows
+        self._indexed_participants[dm.title] = participants
+        
+    def _index_pending(self, participants=None):
+        """Indexes the conversations merged with index=False that include one of participants (default: all)."""
+        if not self._unindexed_dms:
+            return
+        participants = set(participants) if participants is not None else None
+        indexed = [dm for dm in self._unindexed_dms.values()
+                   if participants is None or not participants.isdisjoint(dm.participants)]
+        # Conversations are indexed in self.dms order, so only the participants indexed before can end up out of order
+        reorder = set().union(*(dm.participants for dm in indexed)) & self.participant_index.keys()
+        for dm in indexed:
+            self._index_dm(dm)
+            del self._unindexed_dms[dm.title]
+        for participant in reorder:
+            index = self.participant_index[participant]
+            self.participant_index[participant] = {title: index[title] for title in self.dms if title in index}
             
-    def _common_words_from_partipant(self, participant):
-        def normalize_text(text):
-            return re.sub(r'\W+', ' ', text.lower()).strip()
-            # return re.sub(r'[^a-zA-Z0-9 ]', '', text).lower()
+    def participant_rows(self, participant):
+        """Returns [(dm, rows sent by participant)] for every conversation the participant is part of."""
+        self._index_pending([participant])
+        return [(self.dms[title], rows) for title, rows in self.participant_index.get(participant, {}).items()]
+                
+    def refresh(self):
+        """
+        Updates a loaded inbox from a newer export in the same directory, parsing only the new conversations
+        and messages. Returns {title: number of new messages} for the conversations that changed.
+        """
+        if self.archive is not None:
+            raise RuntimeError('An inbox opened with open_mmap cannot be refreshed')
+        if self.dm_filter is None:
+            raise RuntimeError('refresh() requires the inbox to be loaded with init_inbox_processing first')
         
-        participant_messages = []
-        for dm in self.dms.values():
-            if participant not in dm.participants:
+        self.dm_dirs = get_file_dir_from_dir(self.inbox_dir)
+        loaded = {dm.dm_dir: dm for dm in self.dms.values()}
+        new_messages = {}
+        for dm_dir in tqdm(self.dm_dirs, desc='Refreshing Inbox', leave=True):
+            if dm_dir in self.rejected_dm_dirs or dm_dir in self.shadowed_dm_dirs:
                 continue
             
-            for message in dm.messages:
-                if message.sender_name == participant:
-                    participant_messages.append(normalize_text(message.content.text))
+            dm = loaded.get(dm_dir)
+            if dm is None:
+                dm = _load_dm(dm_dir, self.message_filter, self.cache_dir)
+                self._merge_dms([dm], self.dm_filter)
+                if dm.dm_dir in self.rejected_dm_dirs or len(dm.messages) == 0:
+                    continue
+                new_messages[dm.title] = len(dm.messages)
+            elif dm.refresh(self.message_filter):
+                self.all_participants.update(dm.participants)
+                self._index_dm(dm)
+                new_messages[dm.title] = len(dm.messages) - dm.new_messages_start
+        return new_messages
+                
+    def __repr__(self):
+        return f'{self.dms.keys()}'
+            
+    def _common_words_from_partipant(self, participant):
+        # Counts whole normalized messages (the participant's most repeated messages); see text_stats for words
+        participant_messages = Counter()
+        for dm, rows in self.participant_rows(participant):
+            texts = dm.messages.texts
+            participant_messages.update(normalize_text(texts[row]) for row in rows.tolist())
                     
-        return Counter(participant_messages)
+        return participant_messages
     
-    def _default_message_format(self, message: Message, ref_datetime: datetime) -> str:
-        return str(message)
+    def text_stats(self, participants=None, ngram_sizes=(1,), k=100, **sketch_options):
+        """
+        Word n-gram frequencies of the text messages of participants (default: everyone), computed in one
+        pass over the inbox; only the top-k n-grams of each participant are kept once they are counted
+        (see text_stats.TextStats).
+        stats.most_common(participant, n) then gives the top-k n-grams with their estimated counts.
+        """
+        stats = TextStats(ngram_sizes, k, **sketch_options)
+        if participants is None:
+            self._index_pending()
+            participants = self.participant_index.keys()
+        elif isinstance(participants, str):
+            participants = [participants]
+        for participant in tqdm(dict.fromkeys(participants), desc='Text Statistics', leave=True):
+            for dm, rows in self.participant_rows(participant):
+                texts = dm.messages.texts
+                for row in rows.tolist():
+                    if texts[row]:
+                        stats.add(participant, texts[row])
+            stats.finish(participant)
+        return stats
+    
+    def common_words(self, participant, n=1, top=20):
+        """The top most frequent word n-grams of participant, with their (estimated) counts."""
+        return self.text_stats(participant, (n,), k=max(top, 100)).most_common(participant, n, top)
+    
+    def _unique_exchange_rows(self, dm_rows, dedup):
+        # Drops the responses whose exchange (the message replied to and the response) nearly duplicates an earlier one
+        unique_dm_rows = []
+        for dm, rows in dm_rows:
+            texts = dm.messages.texts
+            keep = [not dedup.is_duplicate(f'{texts[row-1] if row > 0 else ""}\n{texts[row]}') for row in rows.tolist()]
+            unique_dm_rows.append((dm, rows[np.array(keep, dtype=bool)]))
+        return unique_dm_rows
     
     def _save_dataset(self, dataset, file_path):        
         with open(file_path, 'w') as file:
             json.dump(dataset, file)
     
-    def create_chat_dataset(self, target_participant, context_size=10, message_format=None):
+    def iter_chat_dataset(self, target_participant, context_size=10, message_format=None, time_bucket=None, max_workers=None,
+                          only_new=False, packer=None, dedup=None):
+        """
+        Lazily yields (context, response) pairs for every message sent by target_participant, the context being
+        the context_size messages before it (or those fitting packer's budget) formatted with message_format.
+        only_new keeps the messages added by the last refresh(); dedup skips near-duplicate exchanges.
+        """
         if message_format is None:
-            message_format = self._default_message_format
-            
-        dataset = []
-        for dm in tqdm(self.dms.values(), desc='Creating Chat Dataset', leave=True):
-            if target_participant not in dm.participants:
-                continue
+            message_format = default_message_format
             
-            for i, message in tqdm(enumerate(dm.messages), desc=f'Processing {dm.title} Messages', leave=False):
-                if message.sender_name == target_participant:
-                    response = message.content.text
-                    curr_time = message.datetime
-                    
-                    context = deque(maxlen=context_size)
-                    for j in range(i-1, i-context_size-1, -1):
-                        if j < 0:
-                            break
-                        context.appendleft(message_format(dm.messages[j], curr_time))
-                    
-                    data_point = {
-                        'context': "\n".join(list(context)),
-                        'response': response
-                    }
-                    dataset.append(data_point)
-                    
-                    
+        dm_rows = self.participant_rows(target_participant)
+        if dedup is not None:
+            dm_rows = self._unique_exchange_rows(dm_rows, dedup)
+        if max_workers and max_workers > 1:
+            _check_picklable(message_format, 'message_format', 'max_workers')
+            _check_picklable(packer, 'packer', 'max_workers')
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = executor.map(_chat_data_points, *zip(*dm_rows), repeat(context_size),
+                                       repeat(message_format), repeat(time_bucket),
+                                       [dm.new_messages_start if only_new else 0 for dm, _ in dm_rows], repeat(packer))
+                for data_points in tqdm(results, total=len(dm_rows), desc='Creating Chat Dataset', leave=True):
+                    yield from data_points
+        else:
+            for dm, rows in tqdm(dm_rows, desc='Creating Chat Dataset', leave=True):
+                yield from _iter_chat_data_points(dm, rows, context_size, message_format, time_bucket,
+                                                  dm.new_messages_start if only_new else 0, packer)
+    
+    def create_chat_dataset(self, target_participant, context_size=10, message_format=None, time_bucket=None, max_workers=None,
+                            writer=None, only_new=False, packer=None, dedup=None):
+        """
+        Builds the chat dataset (see iter_chat_dataset) and saves it to <target_participant>_dataset.json.
+        If a ShardedDatasetWriter is given, nothing is collected: a lazy iterator is returned instead that
+        streams each data point into the writer's shards as it is consumed.
+        """
+        data_points = self.iter_chat_dataset(target_participant, context_size, message_format, time_bucket, max_workers, only_new,
+                                             packer, dedup)
+        if writer is not None:
+            return writer.stream(data_points)
+        
+        dataset = list(data_points)
         self._save_dataset(dataset, f'{target_participant}_dataset.json')
         
         return dataset
     
-    def create_timing_dataset(self, target_participant, context_size=10, message_format=None):
-        
-        high_density_chat_windows = []
-        for dm in tqdm(self.dms.values(), desc='Creating Timing Dataset', leave=True):
-            if target_participant not in dm.participants:
-                continue
-            
-            messages = list(dm.messages)
-            
-            chat_window = []
-            sender_indices = []
-            ref_i = None
-            for i, message in enumerate(messages):
-                if ref_i == None and message.sender_name == target_participant:
-                    start_i = i-context_size if i-context_size >= 0 else 0
-                    chat_window.extend(messages[start_i:i])   
-                    sender_indices.append(len(chat_window)-1)
-                    ref_i = i
-                    
-                if ref_i != None:
-                    if i - ref_i <= context_size:
-                        chat_window.append(message)
-                        if message.sender_name == target_participant:
-                            ref_i = i
-                            sender_indices.append(len(chat_window)-1)
-                    else:
-                        high_density_chat_windows.append((chat_window, sender_indices))
-                        chat_window = []
-                        sender_indices = []
-                        ref_i = None
-                        
-        # High density chat windows are the chat windows where the target participant is active
-        # From high density chat windows, extract  
-        
-        dataset = []
-        for chat_window, sender_indices in high_density_chat_windows:
-            num_target_messages = len(sender_indices)
-            avail_indices = set(range(context_size+1, len(chat_window)))
-            avail_indices -= set(sender_indices)
-            
-            if num_target_messages > len(avail_indices):
-                continue
+    def iter_timing_dataset(self, target_participant, context_size=10, message_format=None, only_new=False, packer=None,
+                            window_seconds=None, seed=1, max_workers=None):
+        """
+        Lazily yields labelled contexts: label 1 when target_participant sent the next message, 0 otherwise.
+        Data points come from the windows where the target is active (see _timing_windows), consecutive
+        target messages belonging to one window while they are at most context_size messages apart, or
+        at most window_seconds apart when given. Each window yields as many negatives, sampled from its
+        other messages with a generator seeded by seed and the conversation, as it has positives.
+        only_new restricts the data points to those whose next message was added by the last refresh().
+        A ContextPacker limits each context to its token budget, as in iter_chat_dataset. With
+        max_workers > 1 conversations are processed in a process pool (message_format and packer must
+        then be picklable); the output is the same either way.
+        """
+        if message_format is None:
+            message_format = default_message_format
             
-            selected_indices = random.sample(list(avail_indices), num_target_messages)
-            for i in selected_indices:
-                start_i = i-context_size if i-context_size >= 0 else 0
-                context = [message_format(message, chat_window[i].datetime) for message in chat_window[start_i:i]]
-                label = 0
-                
-                data_point = {
-                    'context': '\n'.join(context),
-                    'label': label
-                }
-                dataset.append(data_point)
-                
-            for i in sender_indices:
-                start_i = i-context_size if i-context_size >= 0 else 0
-                context = [message_format(message, chat_window[i].datetime) for message in chat_window[start_i:i]]
-                label = 1
-                
-                data_point = {
-                    'context': '\n'.join(context),
-                    'label': label
-                }
-                dataset.append(data_point)
+        dms = [dm for dm, _ in self.participant_rows(target_participant)]
+        args = (repeat(target_participant), repeat(context_size), repeat(message_format),
+                [dm.new_messages_start if only_new else 0 for dm in dms], repeat(packer), repeat(window_seconds), repeat(seed))
+        if max_workers and max_workers > 1:
+            _check_picklable(message_format, 'message_format', 'max_workers')
+            _check_picklable(packer, 'packer', 'max_workers')
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = executor.map(_timing_data_points, dms, *args)
+                for data_points in tqdm(results, total=len(dms), desc='Creating Timing Dataset', leave=True):
+                    yield from data_points
+        else:
+            for dm, *dm_args in tqdm(zip(dms, *args), total=len(dms), desc='Creating Timing Dataset', leave=True):
+                yield from _iter_timing_data_points(dm, *dm_args)
                 
+    def create_timing_dataset(self, target_participant, context_size=10, message_format=None, writer=None, only_new=False,
+                              packer=None, window_seconds=None, seed=1, max_workers=None):
+        """
+        Builds the timing dataset (see iter_timing_dataset) and saves it to <target_participant>_timing_dataset.json,
+        or returns a lazy iterator streaming into writer when one is given.
+        """
+        data_points = self.iter_timing_dataset(target_participant, context_size, message_format, only_new, packer,
+                                               window_seconds, seed, max_workers)
+        if writer is not None:
+            return writer.stream(data_points)
+        
+        dataset = list(data_points)
         self._save_dataset(dataset, f'{target_participant}_timing_dataset.json')
         
         return dataset
     
-    def plot_active_hours(self, target_participant):
+    def activity_stats(self, participants, tz=None):
         """
-        Graphs the active times of the target participant throughout the day.
-        The function creates a histogram of message counts by hour (0-23).
+        Computes {participant: stats} in one vectorised pass: hourly and weekday message counts, per hour comment
+        and reply counts, reply_probability and response_latencies_s (hours in tz, see _local_hours_and_weekdays).
         """
-        hours = []
+        if isinstance(participants, str):
+            participants = [participants]
+            
+        stats = {participant: {
+            'hourly_counts': np.zeros(24, dtype=np.int64),
+            'weekday_counts': np.zeros(7, dtype=np.int64),
+            'comment_counts': np.zeros(24, dtype=np.int64),
+            'reply_counts': np.zeros(24, dtype=np.int64),
+            'response_latencies_s': [],
+        } for participant in participants}
         
-        for dm in tqdm(self.dms.values(), desc='Active Analysis', leave=True):
-            if target_participant not in dm.participants:
+        self._index_pending(participants)
+        dm_participants = {}
+        for participant in participants:
+            for title, rows in self.participant_index.get(participant, {}).items():
+                dm_participants.setdefault(title, []).append((participant, rows))
+                
+        for title, participant_rows in tqdm(dm_participants.items(), desc='Activity Analysis', leave=True):
+            store = self.dms[title].messages
+            if len(store) == 0:
                 continue
             
-            for message in dm.messages:
-                if message.sender_name == target_participant and message.content.text:
-                    hours.append(message.datetime.hour)
+            hours, weekdays = _local_hours_and_weekdays(store.timestamps_ms, tz)
+            has_text = np.fromiter(map(bool, store.texts), dtype=bool, count=len(store))
+            for participant, rows in participant_rows:
+                participant_stats = stats[participant]
+                is_sender = np.zeros(len(store), dtype=bool)
+                is_sender[rows] = True
+                sent = is_sender & has_text
+                participant_stats['hourly_counts'] += np.bincount(hours[sent], minlength=24)
+                participant_stats['weekday_counts'] += np.bincount(weekdays[sent], minlength=7)
+                
+                comments = ~is_sender[:-1]
+                replies = comments & is_sender[1:]
+                participant_stats['comment_counts'] += np.bincount(hours[:-1][comments], minlength=24)
+                participant_stats['reply_counts'] += np.bincount(hours[:-1][replies], minlength=24)
+                latencies = (store.timestamps_ms[1:][replies] - store.timestamps_ms[:-1][replies])/1000
+                participant_stats['response_latencies_s'].append(latencies)
+                
+        for participant_stats in stats.values():
+            latencies = participant_stats['response_latencies_s']
+            participant_stats['response_latencies_s'] = np.concatenate(latencies) if latencies else np.zeros(0)
+            participant_stats['reply_probability'] = np.divide(
+                participant_stats['reply_counts'], participant_stats['comment_counts'],
+                out=np.zeros(24), where=participant_stats['comment_counts'] > 0)
+        return stats
+    
+    def plot_active_hours(self, target_participant, tz=None):
+        """
+        Graphs the active times of the target participant throughout the day.
+        The function creates a histogram of message counts by hour (0-23).
+        """
+        hourly_counts = self.activity_stats(target_participant, tz)[target_participant]['hourly_counts']
         
-        if not hours:
+        if not hourly_counts.any():
             print(f"No messages found for {target_participant}")
             return
         
         plt.figure(figsize=(10, 6))
-        plt.hist(hours, bins=24, range=(0, 24), edgecolor='black')
+        plt.bar(range(24), hourly_counts, width=1, align='edge', edgecolor='black')
         plt.title(f"Active Times of {target_participant} Throughout the Day")
         plt.xlabel("Hour of Day")
         plt.ylabel("Number of Messages")
         plt.xticks(range(0, 25))
         plt.show()
         
-    def plot_reply_probability(self, target_participant):
+    def plot_reply_probability(self, target_participant, tz=None):
         """
         Plots the probability at each hour of day that the target participant replies to a comment.
         For each message not sent by the target, if the next message is from the target, it is considered a reply.
         """
-        reply_counts = {hour: 0 for hour in range(24)}
-        total_counts = {hour: 0 for hour in range(24)}
-        
-        for dm in self.dms.values():
-            if target_participant not in dm.participants:
-                continue
-            
-            messages = list(dm.messages)
-            for i in range(len(messages) - 1):
-                current_msg = messages[i]
-                next_msg = messages[i+1]
-                # Only consider messages not from the target as potential comments
-                if current_msg.sender_name != target_participant:
-                    hour = current_msg.datetime.hour
-                    total_counts[hour] += 1
-                    if next_msg.sender_name == target_participant:
-                        reply_counts[hour] += 1
-        
-        # Calculate reply probabilities for each hour (0-23)
+        probabilities = self.activity_stats(target_participant, tz)[target_participant]['reply_probability'].tolist()
         hours = list(range(24))
-        probabilities = []
-        for hour in hours:
-            if total_counts[hour] > 0:
-                probabilities.append(reply_counts[hour] / total_counts[hour])
-            else:
-                probabilities.append(0)
         
         # Plot the probabilities per hour
         plt.figure(figsize=(10, 6))
@@ -324,4 +1035,3 @@ class Inbox:
         # Save the probabilities to a JSON file
         with open(f'{target_participant}_reply_probabilities.json', 'w') as file:
             json.dump(probabilities, file)
-            
\ No newline at end of file
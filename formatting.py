@@ -0,0 +1,145 @@
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+_suffixes = {}
+
+def first_name(full_name):
+    return full_name.split(" ")[0]
+
+def _time_ago_suffix(hours, minutes):
+    key = (hours, minutes) if hours < 1 else (hours, 0)
+    suffix = _suffixes.get(key)
+    if suffix is None:
+        if hours >= 1:
+            suffix = f"{hours} hour{'s' if hours != 1 else ''} ago"
+        else:
+            suffix = f"{minutes} minute{'s' if minutes != 1 else ''} ago"
+        _suffixes[key] = suffix
+    return suffix
+
+def time_ago(seconds):
+    """'3 hours ago' / '1 minute ago' for a number of elapsed seconds."""
+    return _time_ago_suffix(int(seconds // 3600), int(seconds // 60))
+
+def time_ago_many(seconds):
+    """time_ago of every element of an array of elapsed seconds; the divisions are vectorised."""
+    seconds = np.asarray(seconds, dtype=np.float64)
+    hours = np.floor_divide(seconds, 3600).astype(np.int64).tolist()
+    minutes = np.floor_divide(seconds, 60).astype(np.int64).tolist()
+    return [_time_ago_suffix(h, m) for h, m in zip(hours, minutes)]
+
+class RelativeTimeFormat:
+    """
+    Formats messages the way the monitor prompts the model: '<First name> (N minutes ago): text', the
+    time being relative to a reference time. Usable as the message_format of the dataset builders,
+    so the training contexts match the live prompts.
+    Only the relative time depends on the reference: format_window renders it for a whole window of
+    stored rows at once and reuses the '<First name> (' part cached per sender, instead of
+    formatting each (message, reference) pair from scratch as __call__ does.
+    """
+    def __init__(self):
+        self._heads = {}
+
+    def head(self, sender_name):
+        head = self._heads.get(sender_name)
+        if head is None:
+            head = self._heads[sender_name] = f"<{first_name(sender_name)}> ("
+        return head
+
+    def __call__(self, message, ref_datetime):
+        return f"{self.head(message.sender_name)}{time_ago(ref_datetime.timestamp() - message.epoch_time)}): {message.content.text}"
+
+    def window_parts(self, store, rows, ref_ms):
+        """
+        (head, relative time, tail) of the formatted lines of the given rows of a dm_analyzer.MessageStore,
+        relative to ref_ms (epoch milliseconds); see ContextPacker.count_parts.
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        suffixes = time_ago_many((ref_ms - store.timestamps_ms[rows]) / 1000)
+        heads = [self.head(sender) for sender in store.senders]
+        texts = store.texts
+        return [(heads[sender_id], suffix, f"): {texts[row]}")
+                for sender_id, suffix, row in zip(store.sender_ids[rows].tolist(), suffixes, rows.tolist())]
+
+    def format_window(self, store, rows, ref_ms):
+        """Formatted lines of the given rows of a dm_analyzer.MessageStore, relative to ref_ms (epoch milliseconds)."""
+        return [head + suffix + tail for head, suffix, tail in self.window_parts(store, rows, ref_ms)]
+
+class FormattedLineCache:
+    """
+    Keeps the invariant parts of formatted live messages (sender head and text) by message id, so a poll
+    only renders the relative times of the messages it shares with the previous polls. Bounded to
+    max_size messages, least recently used first out.
+    """
+    def __init__(self, max_size=10_000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, message_id):
+        entry = self._entries.get(message_id)
+        if entry is not None:
+            self._entries.move_to_end(message_id)
+        return entry
+
+    def put(self, message_id, head, tail):
+        self._entries[message_id] = (head, tail)
+        self._entries.move_to_end(message_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+class AnchoredThreadContext:
+    """
+    Keeps the context of each live thread append-only between polls, so the prompt of a poll extends the
+    previous one and the thread KV cache of InferenceEngine.generate_cached only prefills the new
+    messages. Lines already in a thread's context are not rendered again: their relative time is the one
+    of the poll that added them. The context is rebuilt from the latest messages (re-anchored) when the
+    new messages do not follow it, when it would exceed twice the messages of a fresh context or the
+    token budget of the packer, and once it is older than max_age_s, which bounds how stale its
+    relative times get. A re-anchored context is packed to (1 - headroom) of the budget, leaving room
+    for the messages appended until the next re-anchor.
+    """
+    def __init__(self, max_age_s=900, headroom=0.25, clock=time.time):
+        self.max_age_s = max_age_s
+        self.headroom = headroom
+        self.clock = clock
+        self._threads = {}
+        self.appends = 0
+        self.anchors = 0
+
+    def update(self, thread_id, message_ids, render, packer=None):
+        """
+        Returns the context lines of thread_id given the ids of its latest messages (oldest first).
+        render(rows) returns the (head, relative time, tail) parts of the messages at the given positions
+        of message_ids, relative to now.
+        """
+        if not message_ids:
+            return []
+
+        def lines_and_counts(rows):
+            parts = render(rows)
+            counts = packer.count_parts(parts) if packer is not None else None
+            return [head + suffix + tail for head, suffix, tail in parts], counts
+
+        now = self.clock()
+        entry = self._threads.get(thread_id)
+        if entry is not None:
+            anchored_at, ids, lines, counts = entry
+            if ids[-1] in message_ids and now - anchored_at < self.max_age_s:
+                start = message_ids.index(ids[-1]) + 1
+                new_lines, new_counts = lines_and_counts(range(start, len(message_ids)))
+                lines = lines + new_lines
+                counts = counts + new_counts if packer is not None else None
+                if len(lines) <= 2 * len(message_ids) and (packer is None or packer.pack_start(counts) == 0):
+                    self._threads[thread_id] = (anchored_at, ids + message_ids[start:], lines, counts)
+                    self.appends += 1
+                    return lines
+
+        lines, counts = lines_and_counts(range(len(message_ids)))
+        if packer is not None:
+            start = packer.pack_start(counts, max(1, int(packer.token_budget * (1 - self.headroom))))
+            lines, counts = lines[start:], counts[start:]
+        self._threads[thread_id] = (now, message_ids[len(message_ids) - len(lines):], lines, counts)
+        self.anchors += 1
+        return lines
@@ -1,4 +1,5 @@
 import os
+import json
 import re
 
 def get_file_dir_with_ext(dir, ext):
@@ -16,4 +17,74 @@ def get_file_dir_from_dir(dir):
 def transcoder(text):
     return text.encode('latin1').decode('utf-8')
 
+def iter_json_fields(file_path, stream_key, chunk_size=1 << 16):
+    """
+    Incrementally parses a file holding a single top-level JSON object.
+    Yields (key, value) for every top-level field; the array stored under stream_key is not
+    materialised, each of its elements is yielded as (stream_key, element) as soon as it is read.
+    """
+    decoder = json.JSONDecoder()
+    with open(file_path, 'r') as file:
+        buffer = file.read(chunk_size)
+        pos = 0
+        eof = not buffer
 
+        def skip(pos, chars=' \t\r\n'):
+            nonlocal buffer, eof
+            while True:
+                while pos < len(buffer) and buffer[pos] in chars:
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    return pos
+                buffer, pos = file.read(chunk_size), 0
+                eof = not buffer
+
+        def decode(pos):
+            nonlocal buffer, eof
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                    # A bare number is only complete once a delimiter follows it
+                    if eof or buffer[pos] in '{["' or (end < len(buffer) and buffer[end] in ' \t\r\n,]}'):
+                        return value, end
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                chunk = file.read(chunk_size)
+                eof = not chunk
+                buffer, pos = buffer[pos:] + chunk, 0
+
+        def expect(pos, char):
+            pos = skip(pos)
+            if pos >= len(buffer) or buffer[pos] != char:
+                raise ValueError(f"Expected '{char}' in {file_path}")
+            return pos + 1
+
+        pos = expect(pos, '{')
+        pos = skip(pos)
+        if pos < len(buffer) and buffer[pos] == '}':
+            return
+        while True:
+            key, pos = decode(skip(pos))
+            pos = expect(pos, ':')
+            pos = skip(pos)
+            if key == stream_key and pos < len(buffer) and buffer[pos] == '[':
+                pos = skip(pos + 1)
+                if pos < len(buffer) and buffer[pos] == ']':
+                    pos += 1
+                else:
+                    while True:
+                        value, pos = decode(skip(pos))
+                        yield key, value
+                        pos = skip(pos)
+                        if pos < len(buffer) and buffer[pos] == ']':
+                            pos += 1
+                            break
+                        pos = expect(pos, ',')
+            else:
+                value, pos = decode(pos)
+                yield key, value
+            pos = skip(pos)
+            if pos < len(buffer) and buffer[pos] == '}':
+                return
+            pos = expect(pos, ',')
@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+from datetime import datetime
+from collections.abc import MutableMapping
+
+import numpy as np
+
+from dm_analyzer import MESSAGE_CLASSIFIER, FLAG_HAS_TEXT, Inbox, MessageStore, DirectMessages
+
+ARCHIVE_MAGIC = b'IGARCH\x00\x01'
+ARCHIVE_VERSION = 1
+_HEADER_POSITION = len(ARCHIVE_MAGIC)
+_ALIGNMENT = 64
+
+def _to_ms(value):
+    """Epoch milliseconds of a datetime, or value itself if it already is a number (or None)."""
+    if isinstance(value, datetime):
+        return int(value.timestamp() * 1000)
+    return value
+
+class ArchiveTexts:
+    """
+    Read-only sequence of the texts of a range of archive rows, decoded from the string pool on access,
+    so opening a conversation does not decode (or even read) any text. Texts of rows without one are None.
+    """
+    __slots__ = ('_pool', '_offsets', '_flags', '_start', '_stop')
+
+    def __init__(self, pool, offsets, flags, start, stop):
+        self._pool = pool
+        self._offsets = offsets
+        self._flags = flags
+        self._start = start
+        self._stop = stop
+
+    def __reduce__(self):
+        # Sent to worker processes as the texts of its rows only, not the whole pool
+        return list, (list(self),)
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def _text(self, row):
+        if not self._flags[row] & FLAG_HAS_TEXT:
+            return None
+        return self._pool[int(self._offsets[row]):int(self._offsets[row+1])].tobytes().decode('utf-8')
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._text(self._start + i) for i in range(*index.indices(len(self)))]
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('text index out of range')
+        return self._text(self._start + index)
+
+    def __iter__(self):
+        for row in range(self._start, self._stop):
+            yield self._text(row)
+
+class ArchiveExtras(MutableMapping):
+    """
+    The row -> (photos, share) dict of a range of archive rows, parsed from the conversation's JSON blob
+    the first time it is accessed rather than when the conversation is opened.
+    """
+    def __init__(self, blob, thread_start, start, stop):
+        self._blob = blob
+        self._thread_start = thread_start
+        self._start = start
+        self._stop = stop
+        self._extras = None
+
+    def _load(self):
+        if self._extras is None:
+            self._extras = {}
+            for row, photos, share in json.loads(self._blob.tobytes()) if len(self._blob) else []:
+                if self._start <= self._thread_start + row < self._stop:
+                    self._extras[self._thread_start + row - self._start] = (photos, share)
+        return self._extras
+
+    def __reduce__(self):
+        return dict, (self._load(),)
+
+    def __getitem__(self, row):
+        return self._load()[row]
+
+    def __setitem__(self, row, extra):
+        self._load()[row] = extra
+
+    def __delitem__(self, row):
+        del self._load()[row]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+class InboxArchive:
+    """
+    Read access to an inbox archive written by write_archive: a single file holding every conversation
+    as global columns (sender ids, timestamps, flags, text offsets), conversation after conversation and
+    each oldest first, a utf-8 string pool for the texts, a timestamp-sorted index of all rows, and a
+    JSON header with the title, participants, senders and first row of each conversation. Sender ids
+    index the senders of their own conversation, like in a MessageStore.
+    Opening only reads the header and memory-maps the file; the columns are numpy views of the map, so
+    a conversation or time range only pages in the rows it touches. The message flags depend on the
+    system message patterns (see dm_analyzer.register_system_pattern): with check_classifier, an archive
+    written with other patterns than the current ones raises ValueError.
+    """
+    def __init__(self, path, check_classifier=True):
+        self.path = path
+        self._map = np.memmap(path, dtype=np.uint8, mode='r')
+        if self._map[:len(ARCHIVE_MAGIC)].tobytes() != ARCHIVE_MAGIC:
+            raise ValueError(f'{path} is not an inbox archive')
+        header_offset, header_length = np.frombuffer(self._map, dtype='<u8', count=2, offset=_HEADER_POSITION)
+        header = json.loads(self._map[int(header_offset):int(header_offset + header_length)].tobytes())
+        if header['version'] != ARCHIVE_VERSION:
+            raise ValueError(f'{path} has archive version {header["version"]}, expected {ARCHIVE_VERSION}')
+
+        self.classifier = header['classifier']
+        if check_classifier and self.classifier != MESSAGE_CLASSIFIER.fingerprint():
+            raise ValueError(f'{path} was written with other system message patterns than the registered ones, so '
+                             'its message flags are stale; convert the export again or pass check_classifier=False')
+        self.threads = header['threads']
+        self.thread_indices = {thread['title']: i for i, thread in enumerate(self.threads)}
+        self.columns = {name: np.frombuffer(self._map, dtype=dtype, count=count, offset=offset)
+                        for name, (offset, dtype, count) in header['sections'].items()}
+        self.thread_starts = self.columns['thread_starts']
+
+    def __len__(self):
+        return len(self.columns['timestamps_ms'])
+
+    def __repr__(self):
+        return f'InboxArchive({self.path!r}, {len(self.threads)} conversations, {len(self)} messages)'
+
+    def titles(self):
+        return list(self.thread_indices)
+
+    def titles_with(self, participant):
+        return [thread['title'] for thread in self.threads if participant in thread['participants']]
+
+    def titles_between(self, since=None, until=None):
+        """Titles of the conversations with messages in [since, until), found from the timestamp index."""
+        sorted_ms = self.columns['time_sorted_ms']
+        lo = 0 if since is None else np.searchsorted(sorted_ms, _to_ms(since), side='left')
+        hi = len(sorted_ms) if until is None else np.searchsorted(sorted_ms, _to_ms(until), side='left')
+        rows = self.columns['time_order'][lo:hi]
+        thread_ids = np.unique(np.searchsorted(self.thread_starts, rows, side='right') - 1)
+        return [self.threads[i]['title'] for i in thread_ids.tolist()]
+
+    def rows(self, title, since=None, until=None):
+        """Global row range [start, stop) of a conversation, restricted to messages in [since, until)."""
+        thread_id = self.thread_indices[title]
+        start, stop = int(self.thread_starts[thread_id]), int(self.thread_starts[thread_id + 1])
+        timestamps = self.columns['timestamps_ms'][start:stop]
+        if since is not None:
+            start, stop = start + int(np.searchsorted(timestamps, _to_ms(since), side='left')), stop
+            timestamps = self.columns['timestamps_ms'][start:stop]
+        if until is not None:
+            stop = start + int(np.searchsorted(timestamps, _to_ms(until), side='left'))
+        return start, stop
+
+    def dm(self, title, since=None, until=None):
+        """The conversation (or its messages in [since, until)) as a DirectMessages backed by the map."""
+        thread_id = self.thread_indices[title]
+        thread = self.threads[thread_id]
+        start, stop = self.rows(title, since, until)
+
+        extras_offset, extras_length = thread['extras']
+        extras = ArchiveExtras(self.columns['extras'][extras_offset:extras_offset + extras_length],
+                               int(self.thread_starts[thread_id]), start, stop)
+
+        texts = ArchiveTexts(self.columns['text_pool'], self.columns['text_offsets'], self.columns['flags'], start, stop)
+        store = MessageStore(thread['senders'], self.columns['sender_ids'][start:stop], self.columns['timestamps_ms'][start:stop],
+                             self.columns['flags'][start:stop], texts, extras)
+        return DirectMessages.from_store(thread['dm_dir'], thread['title'], thread['participants'], store)
+
+def write_archive(inbox, path):
+    """
+    Writes the conversations of a loaded Inbox to a single archive file (see InboxArchive), through a
+    temporary file renamed into place once complete.
+    """
+    dms = list(inbox.dms.values())
+    sections = {}
+
+    def align(file):
+        file.write(bytes(-file.tell() % _ALIGNMENT))
+
+    def write_section(file, name, dtype, chunks):
+        align(file)
+        offset, count = file.tell(), 0
+        for chunk in chunks:
+            chunk = np.ascontiguousarray(chunk, dtype=dtype)
+            file.write(chunk.tobytes())
+            count += len(chunk)
+        sections[name] = [offset, np.dtype(dtype).str, count]
+
+    def encoded_texts(store):
+        return [text.encode('utf-8') if text else b'' for text in store.texts]
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(ARCHIVE_MAGIC + bytes(16))
+
+        thread_starts = np.cumsum([0] + [len(dm.messages) for dm in dms], dtype=np.int64)
+        write_section(file, 'thread_starts', '<i8', [thread_starts])
+        write_section(file, 'sender_ids', '<i4', (dm.messages.sender_ids for dm in dms))
+        write_section(file, 'timestamps_ms', '<i8', (dm.messages.timestamps_ms for dm in dms))
+        write_section(file, 'flags', 'u1', (dm.messages.flags for dm in dms))
+
+        # String pool, then the offsets of each text in it (one more than rows)
+        lengths = []
+        align(file)
+        pool_offset = file.tell()
+        for dm in dms:
+            texts = encoded_texts(dm.messages)
+            file.write(b''.join(texts))
+            lengths.append(np.fromiter(map(len, texts), dtype=np.int64, count=len(texts)))
+        pool_length = file.tell() - pool_offset
+        sections['text_pool'] = [pool_offset, 'u1', pool_length]
+        text_offsets = np.concatenate([[0], np.cumsum(np.concatenate(lengths + [np.zeros(0, np.int64)]))])
+        write_section(file, 'text_offsets', '<i8', [text_offsets])
+
+        timestamps_ms = np.concatenate([dm.messages.timestamps_ms for dm in dms] + [np.zeros(0, np.int64)])
+        time_order = np.argsort(timestamps_ms, kind='stable')
+        write_section(file, 'time_order', '<i8', [time_order])
+        write_section(file, 'time_sorted_ms', '<i8', [timestamps_ms[time_order]])
+        del timestamps_ms, time_order
+
+        threads = []
+        extras_blobs = []
+        extras_offset = 0
+        for dm in dms:
+            blob = json.dumps([[row, photos, share] for row, (photos, share) in dm.messages.extras.items()]).encode() \
+                if dm.messages.extras else b''
+            threads.append({
+                'title': dm.title,
+                'participants': dm.participants,
+                'dm_dir': dm.dm_dir,
+                'senders': dm.messages.senders,
+                'extras': [extras_offset, len(blob)],
+            })
+            extras_blobs.append(blob)
+            extras_offset += len(blob)
+        align(file)
+        sections['extras'] = [file.tell(), 'u1', extras_offset]
+        file.write(b''.join(extras_blobs))
+
+        header = json.dumps({
+            'version': ARCHIVE_VERSION,
+            'classifier': MESSAGE_CLASSIFIER.fingerprint(),
+            'threads': threads,
+            'sections': sections,
+        }).encode()
+        header_offset = file.tell()
+        file.write(header)
+        file.seek(_HEADER_POSITION)
+        file.write(np.array([header_offset, len(header)], dtype='<u8').tobytes())
+    os.replace(tmp_path, path)
+
+def convert_export(inbox_dir, path, message_filter=None, workers=None, cache_dir=None):
+    """Loads an Instagram export inbox directory and writes it to an archive; returns the loaded Inbox."""
+    inbox = Inbox(inbox_dir, cache_dir)
+    inbox.init_inbox_processing(message_filter=message_filter, workers=workers)
+    write_archive(inbox, path)
+    return inbox
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print(f'Usage: python {sys.argv[0]} <inbox directory of the export> <archive file>')
+        sys.exit(1)
+    convert_export(sys.argv[1], sys.argv[2])
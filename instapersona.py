@@ -1,18 +1,10 @@
-import re
+import copy
+from collections import OrderedDict
 
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from huggingface_hub import login
 import torch
 
-from setup import HF_READ_TOKEN, MODEL_NAME, TARGET_NAME
-
-# Authenticate with Hugging Face
-login(token=HF_READ_TOKEN)
-
-# Load the model and tokenizer
-model_name = MODEL_NAME
-model = AutoModelForCausalLM.from_pretrained(model_name, token=True)
-tokenizer = AutoTokenizer.from_pretrained(model_name, token=True)
+from setup import get_config
+from metrics import METRICS
 
 alpaca_prompt = '''Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
 ### Instructions:
@@ -24,37 +16,243 @@ alpaca_prompt = '''Below is an instruction that describes a task, paired with an
 ### Response:
 '''
 
-target_name = TARGET_NAME
 INSTRUCTION = "Write a response as {target_name} for the given context (past conversation) in the input. The response must be what {target_name} would potentialy respond to the given context. The input is formatted as the following: <username> (time past since sent): message"
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-def format_prompts(input):
+# 'hf': the model as published; 'int8': dynamically int8-quantized Linear layers (CPU);
+# 'onnx': exported to ONNX Runtime through optimum (CPU)
+BACKENDS = ('hf', 'int8', 'onnx')
+
+def format_prompts(input, target_name=None):
+    target_name = target_name or get_config("TARGET_NAME")
     return alpaca_prompt.format(INSTRUCTION.format(target_name=target_name), input)
 
-def model_response(input_text):
-    # Prepare the input text
-    input_text = format_prompts(input_text)
+class InferenceEngine:
+    """
+    Keeps the model resident on the device and generates replies for batches of contexts.
+    The Alpaca prompt around the context is formatted once, prompts are left padded so a batch can be
+    generated together, and generation stops at max_new_tokens or as soon as every reply has reached
+    the next "###" section.
+    With prefix_cache, single prompts reuse past key/values instead of re-running prefill: the static
+    instruction prefix is encoded once, and the prompt cache of the last thread_cache_size threads is
+    kept in an LRU so a new poll of a thread only prefills the tokens after the longest common prefix.
+    That prefix only covers the earlier messages when the context of the thread is append-only, as the
+    monitor builds it (see formatting.AnchoredThreadContext); a re-rendered context only reuses the
+    instruction prefix.
+    Tokenization and generation are timed as spans of `metrics`, with counters of prompt cache hits,
+    prefilled and reused prompt tokens and generated tokens (tokens/s is in the trace events).
+    """
+    def __init__(self, model, tokenizer, target_name, device=device, max_new_tokens=128, stop_sequence='###',
+                 prefix_cache=True, thread_cache_size=8, metrics=None):
+        self.model = model.to(device)
+        if hasattr(self.model, 'eval'):
+            # ONNX Runtime models have no training mode
+            self.model.eval()
+        self.tokenizer = tokenizer
+        self.tokenizer.padding_side = 'left'
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.target_name = target_name
+        self.device = device
+        self.max_new_tokens = max_new_tokens
+        self.stop_sequence = stop_sequence
+        
+        prompt_head, self.prompt_suffix = alpaca_prompt.rsplit('{}', 1)
+        self.prompt_prefix = prompt_head.format(INSTRUCTION.format(target_name=target_name))
+        
+        self.prefix_cache = prefix_cache
+        self.thread_cache_size = thread_cache_size
+        self._prefix_entry = None
+        self._thread_entries = OrderedDict()
+        self.metrics = metrics if metrics is not None else METRICS
+        
+    def format_prompt(self, input_text):
+        return self.prompt_prefix + input_text + self.prompt_suffix
+    
+    def extract_response(self, generated_text):
+        response = generated_text.split(self.stop_sequence)[0].strip()
+        return response if response else "?"
+        
+    def generate(self, contexts, max_new_tokens=None):
+        """Returns one reply per context."""
+        return self.generate_prompts([self.format_prompt(context) for context in contexts], max_new_tokens)
+    
+    @torch.inference_mode()
+    def generate_prompts(self, prompts, max_new_tokens=None):
+        """
+        Returns one reply per complete prompt. Prompts formatted by engines of other personas sharing this
+        model and tokenizer can be batched together.
+        """
+        with self.metrics.span('tokenize'):
+            inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.device)
+        
+        with self.metrics.span('model_generate', batch_size=len(prompts)) as span:
+            output = self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens or self.max_new_tokens,
+                num_return_sequences=1,
+                pad_token_id=self.tokenizer.pad_token_id,
+                stop_strings=[self.stop_sequence],
+                tokenizer=self.tokenizer,
+            )
+        
+        # Only decode what was generated after the (padded) prompts
+        generated = output[:, inputs['input_ids'].shape[1]:]
+        generated_tokens = int((generated != self.tokenizer.pad_token_id).sum())
+        self._count_generation(int(inputs['attention_mask'].sum()), 0, generated_tokens, span.duration)
+        return [self.extract_response(text) for text in self.tokenizer.batch_decode(generated, skip_special_tokens=True)]
 
-    # Tokenize the input
-    inputs = tokenizer(input_text, return_tensors="pt")
+    def _get_prefix_entry(self):
+        from transformers import DynamicCache
+        if self._prefix_entry is None:
+            prefix_ids = self.tokenizer(self.prompt_prefix, return_tensors="pt")['input_ids'].to(self.device)
+            with torch.inference_mode():
+                cache = self.model(input_ids=prefix_ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+            self._prefix_entry = (prefix_ids[0], cache)
+        return self._prefix_entry
+    
+    def _count_generation(self, prefill_tokens, reused_tokens, generated_tokens, duration):
+        self.metrics.inc('prefill_tokens_total', prefill_tokens)
+        self.metrics.inc('reused_prompt_tokens_total', reused_tokens)
+        self.metrics.inc('generated_tokens_total', generated_tokens)
+        self.metrics.event('generation', prefill_tokens=prefill_tokens, reused_tokens=reused_tokens,
+                           generated_tokens=generated_tokens, tokens_per_s=generated_tokens / duration if duration else None)
+    
+    @staticmethod
+    def _crop(cache, length):
+        excess = cache.get_seq_length() - length
+        if excess > 0:
+            cache.crop(-excess)
+        return cache
+    
+    @staticmethod
+    def _common_prefix_length(a, b):
+        n = min(len(a), len(b))
+        mismatches = (a[:n] != b[:n]).nonzero()
+        return int(mismatches[0]) if len(mismatches) else n
+    
+    @torch.inference_mode()
+    def generate_cached(self, context, thread_id=None, max_new_tokens=None):
+        """
+        Generates a reply to a single context, reusing the longest cached prompt prefix: the previous
+        prompt of thread_id if any, otherwise the instruction prefix.
+        """
+        from transformers import DynamicCache
+        with self.metrics.span('tokenize'):
+            input_ids = self.tokenizer(self.format_prompt(context), return_tensors="pt")['input_ids'].to(self.device)
+        
+        candidates = [('prefix', *self._get_prefix_entry())]
+        if thread_id is not None and thread_id in self._thread_entries:
+            candidates.append(('thread', *self._thread_entries[thread_id]))
+        best_length, best_cache, best_kind = 0, None, 'miss'
+        for kind, cached_ids, cache in candidates:
+            # At least one prompt token has to be run to get the logits of the first new token
+            length = min(self._common_prefix_length(cached_ids, input_ids[0]), input_ids.shape[1] - 1)
+            if length > best_length:
+                best_length, best_cache, best_kind = length, cache, kind
+        self.metrics.inc('prompt_cache_lookups_total', result=best_kind)
+                
+        past_key_values = DynamicCache()
+        if best_cache is not None:
+            past_key_values = self._crop(copy.deepcopy(best_cache), best_length)
+        
+        with self.metrics.span('model_generate', batch_size=1) as span:
+            output = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=past_key_values,
+                max_new_tokens=max_new_tokens or self.max_new_tokens,
+                num_return_sequences=1,
+                pad_token_id=self.tokenizer.pad_token_id,
+                stop_strings=[self.stop_sequence],
+                tokenizer=self.tokenizer,
+            )
+        self._count_generation(input_ids.shape[1] - best_length, best_length, output.shape[1] - input_ids.shape[1], span.duration)
+        
+        if thread_id is not None:
+            # Keep the cache of the prompt only; the generated reply will not be part of the next prompt
+            self._thread_entries[thread_id] = (input_ids[0], self._crop(past_key_values, input_ids.shape[1]))
+            self._thread_entries.move_to_end(thread_id)
+            while len(self._thread_entries) > self.thread_cache_size:
+                self._thread_entries.popitem(last=False)
+        
+        generated = output[:, input_ids.shape[1]:]
+        return self.extract_response(self.tokenizer.decode(generated[0], skip_special_tokens=True))
 
-    # Load to GPU
-    model.to(device)
-    inputs = {key: value.to(device) for key, value in inputs.items()}
+def _import_ort_model():
+    try:
+        from optimum.onnxruntime import ORTModelForCausalLM
+    except ImportError as e:
+        raise ImportError("The 'onnx' backend requires optimum with ONNX Runtime (pip install optimum[onnxruntime])") from e
+    return ORTModelForCausalLM
 
-    # Generate a response
-    output = model.generate(**inputs, max_length=4096, num_return_sequences=1)
+def load_model(model_name, backend='hf'):
+    """Loads the causal LM of model_name for one of BACKENDS."""
+    from transformers import AutoModelForCausalLM
+    
+    if backend == 'hf':
+        return AutoModelForCausalLM.from_pretrained(model_name, token=True)
+    if backend == 'int8':
+        # Weights of the Linear layers are stored in int8 and activations quantized on the fly;
+        # roughly 4x smaller than float32 and faster on CPUs with int8 dot products
+        model = AutoModelForCausalLM.from_pretrained(model_name, token=True, dtype=torch.float32)
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if backend == 'onnx':
+        return _import_ort_model().from_pretrained(model_name, export=True, token=True)
+    raise ValueError(f"backend must be one of {BACKENDS}, not {backend!r}")
 
-    # Decode and print the response
-    prediction = tokenizer.decode(output[0], skip_special_tokens=True)
+def load_engine(model_name=None, target_name=None, hf_token=None, backend=None, **engine_kwargs):
+    """
+    Logs into Hugging Face, loads the model and tokenizer and wraps them in an InferenceEngine.
+    Settings that are not given are read from setup.get_config; backend defaults to the MODEL_BACKEND
+    setting, or 'hf'. The 'int8' and 'onnx' backends run on CPU, and 'onnx' without the prompt KV cache,
+    which ONNX Runtime models cannot resume from.
+    """
+    from transformers import AutoTokenizer
+    from huggingface_hub import login
+    
+    model_name = model_name or get_config("MODEL_NAME")
+    target_name = target_name or get_config("TARGET_NAME")
+    hf_token = hf_token or get_config("HF_READ_TOKEN")
+    backend = backend or get_config("MODEL_BACKEND", prompt=False) or 'hf'
+    if backend != 'hf':
+        engine_kwargs.setdefault('device', torch.device('cpu'))
+    if backend == 'onnx':
+        engine_kwargs['prefix_cache'] = False
+    
+    # Authenticate with Hugging Face
+    login(token=hf_token)
     
-    # Extract the response from the prediction using the LAST "### Response:"
-    response_match = re.findall(r"### Response:\n(.+?)(?=\n###|\Z)", prediction, re.DOTALL)
-    if response_match:
-        # Get the last response in the list
-        return response_match[-1].strip()
-    else:
-        return "?"
+    # Load the model and tokenizer
+    model = load_model(model_name, backend)
+    tokenizer = AutoTokenizer.from_pretrained(model_name, token=True)
+    return InferenceEngine(model, tokenizer, target_name, **engine_kwargs)
+
+_engine = None
+
+def get_engine():
+    """Returns the shared engine, loading it on first use."""
+    global _engine
+    if _engine is None:
+        _engine = load_engine()
+    return _engine
+
+def set_engine(engine):
+    """Makes model_response use an engine built with explicit settings (see load_engine)."""
+    global _engine
+    _engine = engine
 
+def __getattr__(name):
+    # The module used to expose the loaded model at import time; keep that working lazily
+    if name == 'engine':
+        return get_engine()
+    if name in ('model', 'tokenizer'):
+        return getattr(get_engine(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
+def model_response(input_text, thread_id=None):
+    engine = get_engine()
+    if engine.prefix_cache:
+        return engine.generate_cached(input_text, thread_id)
+    return engine.generate([input_text])[0]
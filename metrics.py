@@ -0,0 +1,160 @@
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Span:
+    """A timed stage; duration (seconds) is set when the span ends."""
+    __slots__ = ('name', 'labels', 'start', 'duration')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.start = time.perf_counter()
+        self.duration = None
+
+class Metrics:
+    """
+    Counters, histograms and gauges of the reply pipeline, in the Prometheus data model.
+    Stages are timed with `with metrics.span('generate')`, which observes the duration in the histogram
+    '<name>_seconds', counts an exception escaping it in errors_total{stage=<name>} and hands a trace
+    event to every sink, with `fields` (e.g. the thread id) that are too many to be labels.
+    inc and observe update counters and histograms by name and labels. Gauges are callables read when
+    the metrics are rendered, e.g. the hit counter of a cache. Safe to use from several threads.
+    Sinks are objects with a record(event) method, see JsonlTraceSink.
+    """
+    def __init__(self, sinks=None, buckets=DEFAULT_BUCKETS):
+        self.sinks = list(sinks or [])
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # Per bucket counts (the last one is +Inf), sum
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+
+    def gauge(self, name, fn, **labels):
+        self.gauges[self._key(name, labels)] = fn
+
+    def event(self, name, **fields):
+        """Hands a trace event to the sinks."""
+        if self.sinks:
+            event = {'time': time.time(), 'name': name, **fields}
+            for sink in self.sinks:
+                sink.record(event)
+
+    @contextmanager
+    def span(self, name, fields=None, **labels):
+        span = Span(name, labels)
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            span.duration = time.perf_counter() - span.start
+            self.observe(f'{name}_seconds', span.duration, **labels)
+            if error is not None:
+                self.inc('errors_total', stage=name, type=error)
+            self.event(name, duration_s=span.duration, error=error, **labels, **(fields or {}))
+
+    def render_prometheus(self):
+        """The metrics in the Prometheus text exposition format."""
+        def series(name, labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return name
+            return name + '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, ([*counts], total)) for key, (counts, total) in self.histograms.items())
+        gauges = sorted(self.gauges.items(), key=lambda item: item[0])
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{series(name, labels)} {value}')
+        for (name, labels), (counts, total) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{series(name + "_bucket", labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{series(name + "_sum", labels)} {total}')
+            lines.append(f'{series(name + "_count", labels)} {cumulative}')
+        for (name, labels), fn in gauges:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{series(name, labels)} {fn()}')
+        return '\n'.join(lines) + '\n'
+
+class JsonlTraceSink:
+    """Appends every trace event (spans and events) as a JSON line to a file."""
+    def __init__(self, path):
+        self.file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        line = json.dumps(event, default=str)
+        with self._lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def serve_prometheus(metrics, port=9100, host='127.0.0.1'):
+    """Serves metrics.render_prometheus() at http://host:port/metrics from a daemon thread. Returns the server."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+# Shared by the monitor and the inference engine unless they are given their own
+METRICS = Metrics()
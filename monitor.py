@@ -2,25 +2,106 @@
 import os
 import sys
 import time
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime
 import random
 
 from instagrapi import Client
 from instagrapi.exceptions import ClientError
 
+from setup import get_config
+from user_cache import UserCache
+from metrics import METRICS, JsonlTraceSink, serve_prometheus
+from context_packer import ContextPacker
+from formatting import AnchoredThreadContext, FormattedLineCache, first_name, time_ago, time_ago_many
+
+class ThreadChangeTracker:
+    """
+    Detects new messages in a set of threads from the inbox listing instead of refetching every thread.
+    Each poll lists the most recently active threads once (one message per thread) and compares their
+    latest message id with the last one seen for that thread; messages are only fetched for the threads
+    that changed. Watched threads missing from the listing have not been active recently, so they are
+    unchanged by definition, and so are threads whose latest message was sent by the logged in account
+    (e.g. the persona's own reply), which must not be answered.
+    Polling adapts to activity: a thread that changed is polled again after min_interval, an idle one
+    backs off by `backoff` per poll up to max_interval, and the inbox is listed when the hottest
+    thread is due.
+    The participants of every listed thread are added to user_cache (a user_cache.UserCache), if given.
+    """
+    def __init__(self, client, thread_ids, context_size=20, min_interval=15, max_interval=120, backoff=1.5, inbox_amount=20,
+                 user_cache=None):
+        self.client = client
+        self.user_cache = user_cache
+        self.thread_ids = list(thread_ids)
+        self.context_size = context_size
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff = backoff
+        self.inbox_amount = inbox_amount
+        self.last_message_ids = {}
+        self.id_to_name = {thread_id: {} for thread_id in self.thread_ids}
+        self.intervals = {thread_id: min_interval for thread_id in self.thread_ids}
+        self.next_poll = {thread_id: 0.0 for thread_id in self.thread_ids}
+        
+    def seconds_until_next_poll(self):
+        return max(0.0, min(self.next_poll.values()) - time.monotonic())
+        
+    def poll_changes(self):
+        """Lists the inbox once and returns the ids of the watched threads that have a new latest message."""
+        now = time.monotonic()
+        listing = {thread.id: thread for thread in self.client.direct_threads(amount=self.inbox_amount, thread_message_limit=1)}
+        if self.user_cache is not None:
+            self.user_cache.prefetch(listing.values())
+        own_user_id = getattr(self.client, 'user_id', None)
+        changed = []
+        for thread_id in self.thread_ids:
+            thread = listing.get(thread_id)
+            latest = thread.messages[0] if thread and thread.messages else None
+            if latest is None or latest.id == self.last_message_ids.get(thread_id):
+                self.intervals[thread_id] = min(self.max_interval, self.intervals[thread_id] * self.backoff)
+            elif own_user_id is not None and str(latest.user_id) == str(own_user_id):
+                self.last_message_ids[thread_id] = latest.id
+                self.intervals[thread_id] = min(self.max_interval, self.intervals[thread_id] * self.backoff)
+            else:
+                self.last_message_ids[thread_id] = latest.id
+                self.intervals[thread_id] = self.min_interval
+                self.id_to_name[thread_id] = {user.pk: user.full_name for user in thread.users}
+                changed.append(thread_id)
+            self.next_poll[thread_id] = now + self.intervals[thread_id]
+        return changed
+    
+    def fetch_messages(self, thread_id):
+        """Returns the last context_size messages of a thread, oldest first."""
+        return self.client.direct_messages(thread_id, amount=self.context_size)[::-1]
+
 class InstagramMonitor:
-    def __init__(self, username, password):
-        self.client = Client()
+    def __init__(self, username, password, client=None, user_cache=None, metrics=None, packer=None):
+        # Any object with the instagrapi Client methods used here works, e.g. replay_client.ReplayClient
+        self.client = client if client is not None else Client()
         self.username = username
         self.password = password
-        self.users_cache = {}
-        self.last_message_id = None
+        # Persisted across restarts and shared by every watched thread
+        self.users_cache = user_cache if user_cache is not None else UserCache()
+        self.metrics = metrics if metrics is not None else METRICS
+        # Limits the formatted context to a token budget when set (see context_packer.ContextPacker)
+        self.packer = packer
+        self.line_cache = FormattedLineCache()
+        # Append-only contexts of the threads replied to, for the engine's thread KV cache
+        self.thread_contexts = AnchoredThreadContext()
+        self.metrics.gauge('user_cache_hits', lambda: self.users_cache.hits)
+        self.metrics.gauge('user_cache_misses', lambda: self.users_cache.misses)
+        self.metrics.gauge('user_cache_size', lambda: len(self.users_cache))
             
         self.client.login(self.username, self.password)
         self.threads = self.client.direct_threads()
+        self.users_cache.prefetch(self.threads)
         
     def logout(self):
         self.client.logout()
+        self.users_cache.close()
         
     def print_threads(self):
         # Print thread IDs and names
@@ -45,21 +126,14 @@ class InstagramMonitor:
     def get_time_ago(self, timestamp):
         """Improved time formatting with plural handling"""
         now = datetime.now(timestamp.tzinfo) if timestamp.tzinfo else datetime.now()
-        delta = now - timestamp
-        total_seconds = delta.total_seconds()
-        
-        hours = int(total_seconds // 3600)
-        if hours >= 1:
-            return f"{hours} hour{'s' if hours != 1 else ''} ago"
-        
-        minutes = int(total_seconds // 60)
-        return f"{minutes} minute{'s' if minutes != 1 else ''} ago"
+        return time_ago((now - timestamp).total_seconds())
 
     def get_username(self, user_id):
         """Get username with error handling and retries"""
         try:
-            if user_id in self.users_cache:
-                return self.users_cache[user_id]
+            cached = self.users_cache.get(user_id)
+            if cached is not None:
+                return cached.username
             
             # Try multiple methods to get username
             try:
@@ -67,112 +141,329 @@ class InstagramMonitor:
             except ClientError:
                 user = self.client.user_short(user_id)
             
-            username = user.username
-            self.users_cache[user_id] = username
-            return username
+            self.users_cache.put(user_id, user.username, user.full_name)
+            return user.username
         except Exception as e:
+            self.metrics.inc('errors_total', stage='get_username', type=type(e).__name__)
             print(f"Error getting username for {user_id}: {e}")
             return f"unknown_user_{user_id}"
 
-    def format_messages(self, messages, id_to_name):
-        """Format messages with error handling"""
-        formatted = []
+    def format_messages(self, messages, id_to_name, thread_id=None, as_list=False):
+        """
+        Format messages with error handling. The sender and text part of a message is formatted once and
+        reused by the next polls (see formatting.FormattedLineCache); only the relative times are rendered
+        again, all at once. With thread_id, the context of the thread is extended rather than rebuilt
+        (see formatting.AnchoredThreadContext). as_list returns the formatted messages instead of their lines.
+        """
+        parts = []
+        timestamps = []
+        message_ids = []
         for msg in messages:
             try:
-                # username = self.get_username(msg.user_id)
-                full_name = id_to_name.get(msg.user_id, TARGET_NAME)
-                user = full_name.split(" ")[0]
-                time_ago = self.get_time_ago(msg.timestamp)
-                formatted.append(f"<{user}> ({time_ago}): {msg.text}")
+                entry = self.line_cache.get(msg.id)
+                if entry is None:
+                    # username = self.get_username(msg.user_id)
+                    full_name = id_to_name[msg.user_id] if msg.user_id in id_to_name else get_config("TARGET_NAME")
+                    entry = (f"<{first_name(full_name)}> (", f"): {msg.text}")
+                    self.line_cache.put(msg.id, *entry)
+                timestamps.append(msg.timestamp.timestamp())
+                parts.append(entry)
+                message_ids.append(msg.id)
             except Exception as e:
+                self.metrics.inc('errors_total', stage='format_message', type=type(e).__name__)
                 print(f"Error formatting message {msg.id}: {e}")
-        return '\n'.join(formatted)
+        
+        def render(rows):
+            now = time.time()
+            rows = list(rows)
+            suffixes = time_ago_many([now - timestamps[row] for row in rows])
+            return [(parts[row][0], suffix, parts[row][1]) for row, suffix in zip(rows, suffixes)]
+        
+        if thread_id is not None:
+            formatted = self.thread_contexts.update(thread_id, message_ids, render, self.packer)
+        else:
+            line_parts = render(range(len(parts)))
+            formatted = [head + suffix + tail for head, suffix, tail in line_parts]
+            if self.packer is not None:
+                formatted = self.packer.pack(formatted, counts=self.packer.count_parts(line_parts))
+        return list(formatted) if as_list else '\n'.join(formatted)
 
-    def monitor_thread(self, thread_id, poll_interval=15):
+    def monitor_thread(self, thread_id, poll_interval=15, max_poll_interval=120, context_size=10):
         """Safer monitoring with increased interval"""
-        thread = self.client.direct_thread(thread_id)
-        id_to_name = {user.pk: user.full_name for user in thread.users}
+        tracker = ThreadChangeTracker(self.client, [thread_id], context_size, poll_interval, max_poll_interval,
+                                      user_cache=self.users_cache)
         
         while True:
             try:
-                thread = self.client.direct_thread(thread_id)
-                if not thread.messages:
-                    time.sleep(poll_interval)
-                    continue
-
-                last_10_messages = thread.messages[-10::-1] if len(thread.messages) >= 10 else thread.messages[::-1]
-                latest_message = last_10_messages[-1]
-                
-                if latest_message.id != self.last_message_id:
-                    self.last_message_id = latest_message.id
-                    formatted = self.format_messages(last_10_messages, id_to_name)
+                with self.metrics.span('poll'):
+                    changed = tracker.poll_changes()
+                self.metrics.inc('polls_total')
+                self.metrics.inc('threads_changed_total', len(changed))
+                for changed_thread_id in changed:
+                    with self.metrics.span('fetch', {'thread_id': changed_thread_id}):
+                        messages = tracker.fetch_messages(changed_thread_id)
+                    formatted = self.format_messages(messages, tracker.id_to_name[changed_thread_id])
                     print('\n' + formatted + '\n')
                 
-                time.sleep(poll_interval)
+                time.sleep(tracker.seconds_until_next_poll())
                 
             except Exception as e:
+                self.metrics.inc('loop_retries_total', type=type(e).__name__)
                 print(f"Critical error: {e}")
                 print("Retrying in 60 seconds...")
                 time.sleep(60)
         
                 
-    def activate_instapersona(self, thread_id, context_size = 20, poll_interval=15, reply_probability=0.6):
-        """Safer monitoring with increased interval"""
-        thread = self.client.direct_thread(thread_id)
-        id_to_name = {user.pk: user.full_name for user in thread.users}
+    def activate_instapersona(self, thread_id, context_size = 20, poll_interval=15, reply_probability=0.6, max_poll_interval=120,
+                              token_budget=512, responder=None):
+        """
+        Safer monitoring with increased interval. The context is the latest messages, at most context_size,
+        that fit in token_budget tokens of the model's tokenizer (no limit with token_budget=None).
+        Replies come from the model loaded in this process, or from responder(context, thread_id=...)
+        when given, e.g. a persona_server.PersonaClient (which packs the context server side). Responders
+        with accepts_messages get the context as the list of formatted messages rather than as one string.
+        """
+        # Only the in-process engine's thread KV cache gains from append-only contexts
+        anchor_context = False
+        if responder is None:
+            # Imported here so that monitoring without the persona never loads torch or the model
+            from instapersona import get_engine, model_response
+            engine = get_engine()
+            responder = model_response
+            anchor_context = engine.prefix_cache
+            if token_budget and self.packer is None:
+                self.packer = ContextPacker(engine.tokenizer, token_budget)
+        
+        tracker = ThreadChangeTracker(self.client, [thread_id], context_size, poll_interval, max_poll_interval,
+                                      user_cache=self.users_cache)
         
         while True:
             try:
-                thread = self.client.direct_thread(thread_id)
-                if not thread.messages:
-                    time.sleep(poll_interval)
-                    continue
-
-                last_10_messages = thread.messages[-context_size:][::-1]
-                latest_message = last_10_messages[-1]
-                
-                if latest_message.id != self.last_message_id:
-                    self.last_message_id = latest_message.id
-                    formatted = self.format_messages(last_10_messages, id_to_name)
-                    print('\n' + formatted + '\n')
-                    response = model_response(formatted)
-                    print(f"Response: {response}")
-                    # reply_probability = REPLY_PROBABILITIES[datetime.now().hour]
-                    print(f"Reply probability: {reply_probability}")
-                    if random.random() < reply_probability:
-                        self.client.direct_send(response, thread_ids=[thread_id])
-                        print(f'Replied successfully with: {response}')
-                
-                time.sleep(poll_interval)
+                self.poll_and_reply(tracker, responder, reply_probability, anchor_context=anchor_context)
+                time.sleep(tracker.seconds_until_next_poll())
                 
             except Exception as e:
+                self.metrics.inc('loop_retries_total', type=type(e).__name__)
                 print(f"Critical error: {e}")
                 print("Retrying in 60 seconds...")
                 time.sleep(60)
 
-from instapersona import model_response
-from setup import IG_USERNAME, IG_PASSWORD, TARGET_NAME
+    def poll_and_reply(self, tracker, responder, reply_probability=0.6, verbose=True, anchor_context=False):
+        """
+        Runs one poll of the reply pipeline: detect changed threads, fetch, format, generate and maybe send.
+        Every stage is a span of self.metrics; returns one record per changed thread with the duration
+        in seconds of each stage. anchor_context keeps the contexts append-only (see format_messages),
+        which only pays off with a responder using InferenceEngine.generate_cached.
+        """
+        records = []
+        with self.metrics.span('poll') as poll:
+            changed = tracker.poll_changes()
+        self.metrics.inc('polls_total')
+        self.metrics.inc('threads_changed_total', len(changed))
+        
+        for thread_id in changed:
+            record = {'thread_id': thread_id, 'poll_s': poll.duration, 'sent': False}
+            fields = {'thread_id': thread_id}
+            
+            with self.metrics.span('fetch', fields) as span:
+                messages = tracker.fetch_messages(thread_id)
+            record['fetch_s'] = span.duration
+            
+            with self.metrics.span('format', fields) as span:
+                formatted = self.format_messages(messages, tracker.id_to_name[thread_id],
+                                                 thread_id if anchor_context else None, as_list=True)
+            record['format_s'] = span.duration
+            if verbose:
+                print('\n' + '\n'.join(formatted) + '\n')
+            
+            with self.metrics.span('generate', fields) as span:
+                context = formatted if getattr(responder, 'accepts_messages', False) else '\n'.join(formatted)
+                response = responder(context, thread_id=thread_id)
+            record['generate_s'] = span.duration
+            if verbose:
+                print(f"Response: {response}")
+                # reply_probability = REPLY_PROBABILITIES[datetime.now().hour]
+                print(f"Reply probability: {reply_probability}")
+            
+            if random.random() < reply_probability:
+                with self.metrics.span('send', fields) as span:
+                    self.client.direct_send(response, thread_ids=[thread_id])
+                record['send_s'] = span.duration
+                record['sent'] = True
+                self.metrics.inc('replies_sent_total')
+                if verbose:
+                    print(f'Replied successfully with: {response}')
+            else:
+                self.metrics.inc('replies_skipped_total')
+            records.append(record)
+        return records
+
+class AsyncInstagramMonitor:
+    """
+    Watches many threads concurrently from one process, sharing the logged in client of an InstagramMonitor.
+    Changes are detected for all threads at once from the inbox listing (see ThreadChangeTracker) and
+    blocking instagrapi calls run in a bounded thread pool. Replies are produced by a single inference
+    worker fed through a queue, so a slow model_response never delays the polling of other threads;
+    if a thread changes again while its previous context is still waiting, only the newest context is kept.
+    """
+    def __init__(self, monitor, max_io_workers=4, responder=None):
+        self.monitor = monitor
+        self.client = monitor.client
+        self.metrics = monitor.metrics
+        self.io_executor = ThreadPoolExecutor(max_workers=max_io_workers, thread_name_prefix='instagrapi')
+        self.inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inference')
+        self.responder = responder
+        # Set by run when replies come from the in-process engine (see InstagramMonitor.poll_and_reply)
+        self.anchor_context = False
+        self.tracker = None
+        self._pending = {}
+        self._queue = None
+        
+    async def _call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.io_executor, partial(fn, *args, **kwargs))
+    
+    async def _poll_inbox(self, tracker, reply):
+        while True:
+            try:
+                with self.metrics.span('poll'):
+                    changed = await self._call(tracker.poll_changes)
+                self.metrics.inc('polls_total')
+                self.metrics.inc('threads_changed_total', len(changed))
+                # Only the threads that changed are fetched, concurrently
+                with self.metrics.span('fetch', {'thread_ids': changed}):
+                    fetched = await asyncio.gather(*(self._call(tracker.fetch_messages, thread_id) for thread_id in changed))
+                for thread_id, messages in zip(changed, fetched):
+                    with self.metrics.span('format', {'thread_id': thread_id}):
+                        formatted = self.monitor.format_messages(messages, tracker.id_to_name[thread_id],
+                                                                 thread_id if reply and self.anchor_context else None,
+                                                                 as_list=True)
+                    print(f'\n[{thread_id}]\n' + '\n'.join(formatted) + '\n')
+                    if reply:
+                        if thread_id not in self._pending:
+                            self._queue.put_nowait(thread_id)
+                        else:
+                            self.metrics.inc('contexts_coalesced_total')
+                        self._pending[thread_id] = formatted
+                        
+                await asyncio.sleep(tracker.seconds_until_next_poll())
+                
+            except Exception as e:
+                self.metrics.inc('loop_retries_total', type=type(e).__name__)
+                print(f"Critical error: {e}")
+                print("Retrying in 60 seconds...")
+                await asyncio.sleep(60)
+                
+    async def _inference_worker(self, reply_probability):
+        loop = asyncio.get_running_loop()
+        while True:
+            thread_id = await self._queue.get()
+            formatted = self._pending.pop(thread_id)
+            if not getattr(self.responder, 'accepts_messages', False):
+                formatted = '\n'.join(formatted)
+            fields = {'thread_id': thread_id}
+            try:
+                with self.metrics.span('generate', fields):
+                    response = await loop.run_in_executor(self.inference_executor, partial(self.responder, formatted, thread_id=thread_id))
+                print(f"Response [{thread_id}]: {response}")
+                if random.random() < reply_probability:
+                    with self.metrics.span('send', fields):
+                        await self._call(self.client.direct_send, response, thread_ids=[thread_id])
+                    self.metrics.inc('replies_sent_total')
+                    print(f'Replied successfully to {thread_id} with: {response}')
+                else:
+                    self.metrics.inc('replies_skipped_total')
+            except Exception as e:
+                # Already counted in errors_total by the failing span
+                print(f"Error replying to thread {thread_id}: {e}")
+            finally:
+                self._queue.task_done()
+    
+    async def run(self, thread_ids, context_size=20, poll_interval=15, reply_probability=0.6, reply=True, max_poll_interval=120,
+                  token_budget=512):
+        if reply and self.responder is None:
+            # Imported here so that monitoring without the persona never loads torch or the model
+            from instapersona import get_engine, model_response
+            engine = await asyncio.get_running_loop().run_in_executor(self.inference_executor, get_engine)
+            self.responder = model_response
+            self.anchor_context = engine.prefix_cache
+            if token_budget and self.monitor.packer is None:
+                self.monitor.packer = ContextPacker(engine.tokenizer, token_budget)
+            
+        self._queue = asyncio.Queue()
+        self.tracker = ThreadChangeTracker(self.client, thread_ids, context_size, poll_interval, max_poll_interval,
+                                           user_cache=self.monitor.users_cache)
+        tasks = [asyncio.create_task(self._poll_inbox(self.tracker, reply))]
+        if reply:
+            tasks.append(asyncio.create_task(self._inference_worker(reply_probability)))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+                
+    def start(self, thread_ids, **kwargs):
+        """Blocking entry point: runs the monitor until interrupted."""
+        try:
+            asyncio.run(self.run(thread_ids, **kwargs))
+        finally:
+            self.io_executor.shutdown(wait=False, cancel_futures=True)
+            self.inference_executor.shutdown(wait=False, cancel_futures=True)
 
 # import json 
 # with open(f"{TARGET_NAME}_reply_probabilities.json", "r") as file:
 #     REPLY_PROBABILITIES = json.load(file)
 # reply probabilities include the probability of the response at a hour (0-23) for a given message
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Monitor an Instagram thread and reply as the persona")
+    parser.add_argument("--thread-name", action="append", help="title of a thread to watch; repeat to watch several threads concurrently")
+    parser.add_argument("--no-model", action="store_true", help="only print new messages, without loading the model")
+    parser.add_argument("--poll-interval", type=int, default=15)
+    parser.add_argument("--server", help="URL of a persona_server to get replies from instead of loading the model")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics at http://127.0.0.1:<port>/metrics")
+    parser.add_argument("--trace-file", help="append a JSON line per pipeline stage to this file")
+    return parser.parse_args()
+
 # Usage example
 if __name__ == "__main__":
+    args = parse_args()
+    if args.metrics_port:
+        serve_prometheus(METRICS, args.metrics_port)
+    if args.trace_file:
+        METRICS.add_sink(JsonlTraceSink(args.trace_file))
+    
     # Initialize with your Instagram credentials
-    monitor = InstagramMonitor(IG_USERNAME, IG_PASSWORD)
+    monitor = InstagramMonitor(get_config("IG_USERNAME"), get_config("IG_PASSWORD"))
     
     # Print threads
     monitor.print_threads()
     
-    # Get thread ID by name
-    thread_id = monitor.get_thread_id("Thread Name")
+    # Get thread IDs by name
+    thread_names = args.thread_name or ["Thread Name"]
+    thread_ids = [thread_id for thread_id in map(monitor.get_thread_id, thread_names) if thread_id]
+    
+    responder = None
+    if args.server:
+        from persona_server import PersonaClient
+        responder = PersonaClient(args.server)
+    
+    if len(thread_ids) > 1:
+        try:
+            AsyncInstagramMonitor(monitor, responder=responder).start(thread_ids, poll_interval=args.poll_interval,
+                                                                      reply=not args.no_model)
+        except KeyboardInterrupt:
+            print("Monitoring stopped")
+            monitor.logout()
     
     # Start monitoring a specific thread (replace with actual thread ID)
-    if thread_id:
+    elif thread_ids:
+        thread_id = thread_ids[0]
         try:
-            monitor.monitor_thread(thread_id)
+            if args.no_model:
+                monitor.monitor_thread(thread_id, poll_interval=args.poll_interval)
+            else:
+                monitor.activate_instapersona(thread_id, poll_interval=args.poll_interval, responder=responder)
         except KeyboardInterrupt:
             print("Monitoring stopped")
-            monitor.logout()
\ No newline at end of file
+            monitor.logout()
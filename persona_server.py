@@ -0,0 +1,297 @@
+import json
+import time
+import heapq
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from itertools import count
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from setup import get_config
+from metrics import METRICS
+
+class _Request:
+    __slots__ = ('target_name', 'context', 'thread_id', 'max_new_tokens', 'token_budget', 'deadline', 'enqueued',
+                 'done', 'response', 'error')
+
+    def __init__(self, target_name, context, thread_id, max_new_tokens, token_budget, deadline):
+        self.target_name = target_name
+        self.context = context
+        self.thread_id = thread_id
+        self.max_new_tokens = max_new_tokens
+        self.token_budget = token_budget
+        self.deadline = deadline
+        self.enqueued = time.monotonic()
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+class PersonaServer:
+    """
+    Serves persona replies from one copy of the model to any number of monitors over localhost HTTP.
+    Each persona (target_name) gets an InferenceEngine sharing the model and tokenizer. Requests are
+    queued by deadline and a single worker generates them in dynamic batches: it takes the earliest
+    deadlines first, up to max_batch_size, waiting at most max_wait_ms for a batch to fill, so
+    concurrent threads and personas share forward passes. Requests whose deadline passed while queued
+    are answered with 504 without being generated. A lone request of a thread goes through the engine's
+    prompt KV cache (see InferenceEngine.generate_cached) instead.
+
+    POST /generate  {"context", "target_name", "thread_id", "max_new_tokens", "token_budget", "timeout_s"}
+                    -> {"response"}; context is the list of formatted messages, oldest first, which
+                    token_budget packs server side per message (see ContextPacker), or one string used as is
+    GET /health     -> {"personas", "queued"}
+    GET /metrics    -> Prometheus text
+    """
+    def __init__(self, model_name=None, backend=None, host='127.0.0.1', port=8765, max_batch_size=8, max_wait_ms=20,
+                 timeout_s=30.0, max_new_tokens=128, metrics=None, engine=None):
+        self.model_name = model_name
+        self.backend = backend
+        self.host = host
+        self.port = port
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_ms / 1000
+        self.timeout_s = timeout_s
+        self.max_new_tokens = max_new_tokens
+        self.metrics = metrics if metrics is not None else METRICS
+        self.engines = {}
+        self.packers = {}
+        # An already loaded engine can be served instead of loading model_name
+        self._base_engine = engine
+        self._queue = []
+        self._order = count()
+        self._condition = threading.Condition()
+        self._server = None
+        self._worker = None
+        self._stopped = False
+
+    def _get_engine(self, target_name):
+        from instapersona import InferenceEngine, load_engine
+        engine = self.engines.get(target_name)
+        if engine is None:
+            base = self._base_engine
+            if base is None:
+                base = self._base_engine = load_engine(self.model_name, target_name, backend=self.backend,
+                                                       max_new_tokens=self.max_new_tokens, metrics=self.metrics)
+            if base.target_name == target_name:
+                engine = base
+            else:
+                engine = InferenceEngine(base.model, base.tokenizer, target_name, base.device, self.max_new_tokens,
+                                         base.stop_sequence, base.prefix_cache, base.thread_cache_size, self.metrics)
+            self.engines[target_name] = engine
+        return engine
+
+    def _pack(self, engine, messages, token_budget):
+        from context_packer import ContextPacker
+        packer = self.packers.get(token_budget)
+        if packer is None:
+            packer = self.packers[token_budget] = ContextPacker(engine.tokenizer, token_budget)
+        return packer.pack(messages)
+
+    def submit(self, context, target_name=None, thread_id=None, max_new_tokens=None, token_budget=None, timeout_s=None):
+        """Queues a request and blocks until its reply; raises TimeoutError once its deadline has passed."""
+        target_name = target_name or get_config("TARGET_NAME")
+        deadline = time.monotonic() + (timeout_s or self.timeout_s)
+        request = _Request(target_name, context, thread_id, max_new_tokens or self.max_new_tokens, token_budget, deadline)
+        with self._condition:
+            heapq.heappush(self._queue, (deadline, next(self._order), request))
+            self._condition.notify()
+        if not request.done.wait(max(0.0, deadline - time.monotonic())):
+            # The worker drops it when it reaches it; until then it only costs a queue slot
+            self.metrics.inc('server_requests_total', status='timeout')
+            raise TimeoutError(f'No reply within {timeout_s or self.timeout_s} s')
+        if request.error is not None:
+            raise request.error
+        return request.response
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._queue and not self._stopped:
+                self._condition.wait()
+            # Give concurrent requests a moment to join the batch
+            fill_deadline = time.monotonic() + self.max_wait_s
+            while len(self._queue) < self.max_batch_size and not self._stopped:
+                remaining = fill_deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            now = time.monotonic()
+            batch = []
+            while self._queue and len(batch) < self.max_batch_size:
+                deadline, _, request = heapq.heappop(self._queue)
+                if deadline <= now:
+                    request.error = TimeoutError('Deadline passed while queued')
+                    request.done.set()
+                    continue
+                batch.append(request)
+            return batch
+
+    def _generate(self, batch):
+        prompts = []
+        engines = []
+        for request in batch:
+            engine = self._get_engine(request.target_name)
+            if isinstance(request.context, list):
+                # Packed per message: message texts can contain line breaks
+                messages = self._pack(engine, request.context, request.token_budget) if request.token_budget else request.context
+                request.context = '\n'.join(messages)
+            engines.append(engine)
+            prompts.append(engine.format_prompt(request.context))
+
+        with self.metrics.span('server_batch', batch_size=len(batch)):
+            if len(batch) == 1 and engines[0].prefix_cache and batch[0].thread_id is not None:
+                request = batch[0]
+                return [engines[0].generate_cached(request.context, request.thread_id, request.max_new_tokens)]
+            return engines[0].generate_prompts(prompts, max(request.max_new_tokens for request in batch))
+
+    def _run_worker(self):
+        while not self._stopped:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            now = time.monotonic()
+            for request in batch:
+                self.metrics.observe('server_queue_wait_seconds', now - request.enqueued)
+            try:
+                responses = self._generate(batch)
+                for request, response in zip(batch, responses):
+                    request.response = response
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                self.metrics.inc('server_requests_total', status='error' if request.error else 'ok')
+                request.done.set()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, body, content_type='application/json'):
+                data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == '/health':
+                    self._reply(200, {'personas': list(server.engines), 'queued': len(server._queue)})
+                elif self.path == '/metrics':
+                    self._reply(200, server.metrics.render_prometheus(), 'text/plain; version=0.0.4; charset=utf-8')
+                else:
+                    self._reply(404, {'error': f'Unknown path {self.path}'})
+
+            def do_POST(self):
+                if self.path != '/generate':
+                    self._reply(404, {'error': f'Unknown path {self.path}'})
+                    return
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    context = body['context']
+                    if not isinstance(context, (str, list)) or isinstance(context, list) and \
+                            not all(isinstance(message, str) for message in context):
+                        raise TypeError('context must be a string or a list of strings')
+                except (ValueError, KeyError, TypeError) as e:
+                    self._reply(400, {'error': f'Invalid request: {e}'})
+                    return
+                try:
+                    response = server.submit(context, body.get('target_name'), body.get('thread_id'),
+                                             body.get('max_new_tokens'), body.get('token_budget'), body.get('timeout_s'))
+                except TimeoutError as e:
+                    self._reply(504, {'error': str(e)})
+                except Exception as e:
+                    self._reply(500, {'error': f'{type(e).__name__}: {e}'})
+                else:
+                    self._reply(200, {'response': response})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        """Starts the batching worker and the HTTP server in daemon threads. Returns the bound (host, port)."""
+        self._stopped = False
+        self._worker = threading.Thread(target=self._run_worker, name='persona-batcher', daemon=True)
+        self._worker.start()
+        self._server = ThreadingHTTPServer((self.host, self.port), self._make_handler())
+        threading.Thread(target=self._server.serve_forever, name='persona-http', daemon=True).start()
+        return self._server.server_address
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while True:
+                time.sleep(3600)
+        finally:
+            self.stop()
+
+class PersonaClient:
+    """
+    Thin client of a PersonaServer, usable as the responder of InstagramMonitor / AsyncInstagramMonitor:
+    client(context, thread_id=...) returns the reply of target_name. The monitors pass the context as the
+    list of formatted messages (accepts_messages), so the server packs it to token_budget per message.
+    Raises TimeoutError when the server could not answer before timeout_s and RuntimeError on other
+    server errors.
+    """
+    accepts_messages = True
+
+    def __init__(self, url='http://127.0.0.1:8765', target_name=None, timeout_s=30.0, token_budget=512, max_new_tokens=None):
+        self.url = url.rstrip('/')
+        self.target_name = target_name or get_config("TARGET_NAME")
+        self.timeout_s = timeout_s
+        self.token_budget = token_budget
+        self.max_new_tokens = max_new_tokens
+
+    def __call__(self, context, thread_id=None):
+        body = json.dumps({
+            'context': context,
+            'target_name': self.target_name,
+            'thread_id': thread_id,
+            'max_new_tokens': self.max_new_tokens,
+            'token_budget': self.token_budget,
+            'timeout_s': self.timeout_s,
+        }).encode()
+        request = urllib.request.Request(f'{self.url}/generate', body, {'Content-Type': 'application/json'})
+        try:
+            # The HTTP timeout leaves the server time to answer 504 itself
+            with urllib.request.urlopen(request, timeout=self.timeout_s + 5) as response:
+                return json.loads(response.read())['response']
+        except urllib.error.HTTPError as e:
+            message = json.loads(e.read() or b'{}').get('error', str(e))
+            if e.code == 504:
+                raise TimeoutError(message) from e
+            raise RuntimeError(f'Persona server error {e.code}: {message}') from e
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve persona replies from one model to many monitors")
+    parser.add_argument("--model", help="model name (default: MODEL_NAME)")
+    parser.add_argument("--backend", choices=["hf", "int8", "onnx"])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=20)
+    parser.add_argument("--timeout", type=float, default=30.0, help="default deadline of a request, in seconds")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = PersonaServer(args.model, args.backend, port=args.port, max_batch_size=args.max_batch_size,
+                           max_wait_ms=args.max_wait_ms, timeout_s=args.timeout)
+    # Load the model up front rather than on the first request
+    server._get_engine(get_config("TARGET_NAME"))
+    print(f"Serving personas on http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Server stopped")
@@ -0,0 +1,125 @@
+import time
+import threading
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import numpy as np
+
+# Stand-ins for the instagrapi models, with the attributes InstagramMonitor uses
+ReplayUser = namedtuple('ReplayUser', ['pk', 'username', 'full_name'])
+ReplayMessage = namedtuple('ReplayMessage', ['id', 'user_id', 'text', 'timestamp'])
+ReplayThread = namedtuple('ReplayThread', ['id', 'thread_title', 'users', 'messages'])
+
+class ReplayClient:
+    """
+    Offline stand-in for instagrapi.Client that replays conversations of a dm_analyzer.Inbox.
+    Each replayed thread starts empty and its messages appear at their original pace divided by speed,
+    with idle gaps longer than max_gap_s (in export time) shortened to max_gap_s, so a long thread can
+    be replayed in minutes. Messages sent with direct_send are appended to the thread as coming from
+    account_name and recorded in `sent`, with the time since the replayed message they answer
+    appeared (latency_s; None when the latest message of the thread is the account's own).
+    Only text messages are replayed.
+    """
+    def __init__(self, inbox, account_name, thread_titles=None, speed=60.0, max_gap_s=600.0, clock=time.monotonic):
+        self.account_name = account_name
+        self.speed = speed
+        self.clock = clock
+        self.user_ids = {}
+        self.sent = []
+        self._lock = threading.Lock()
+        self.user_id = self._user_id(account_name)
+
+        self.threads = {}
+        titles = thread_titles if thread_titles is not None else list(inbox.dms)
+        for i, title in enumerate(titles):
+            store = inbox.dms[title].messages
+            rows = [row for row, text in enumerate(store.texts) if text]
+            gaps_s = np.diff(store.timestamps_ms[rows], prepend=store.timestamps_ms[rows[:1]]) / 1000 if rows else np.zeros(0)
+            offsets_s = np.cumsum(np.minimum(gaps_s, max_gap_s)) / speed
+            messages = [(float(offset), self._user_id(store.senders[store.sender_ids[row]]), store.texts[row])
+                        for offset, row in zip(offsets_s, rows)]
+            self.threads[str(i)] = {
+                'title': title,
+                'users': [ReplayUser(self._user_id(name), name.replace(' ', '_').lower(), name)
+                          for name in inbox.dms[title].participants],
+                'script': messages,
+                'visible': [],
+            }
+
+        self.start_time = None
+        self.start_datetime = None
+
+    def _user_id(self, name):
+        return self.user_ids.setdefault(name, 1000 + len(self.user_ids))
+
+    def login(self, username=None, password=None):
+        self.start()
+        return True
+
+    def logout(self):
+        return True
+
+    def start(self):
+        """Starts (or restarts) the replay clock."""
+        self.start_time = self.clock()
+        self.start_datetime = datetime.now(timezone.utc)
+        for thread in self.threads.values():
+            thread['visible'] = []
+
+    def elapsed(self):
+        return self.clock() - self.start_time
+
+    def _advance(self, thread_id):
+        thread = self.threads[thread_id]
+        elapsed = self.elapsed()
+        script, visible = thread['script'], thread['visible']
+        while len(visible) < len(script) and script[len(visible)][0] <= elapsed:
+            offset, user_id, text = script[len(visible)]
+            self._append(thread_id, user_id, text, offset)
+        return visible
+
+    def _append(self, thread_id, user_id, text, offset):
+        visible = self.threads[thread_id]['visible']
+        timestamp = datetime.fromtimestamp(self.start_datetime.timestamp() + offset, timezone.utc)
+        message = ReplayMessage(f'{thread_id}-{len(visible)}', user_id, text, timestamp)
+        visible.append((offset, message))
+        return message
+
+    def _thread(self, thread_id, message_limit):
+        with self._lock:
+            visible = self._advance(thread_id)
+            messages = [message for _, message in visible[::-1][:message_limit]]
+        thread = self.threads[thread_id]
+        return ReplayThread(thread_id, thread['title'], thread['users'], messages)
+
+    def direct_threads(self, amount=20, selected_filter="", thread_message_limit=None):
+        threads = [self._thread(thread_id, thread_message_limit) for thread_id in self.threads]
+        threads.sort(key=lambda thread: thread.messages[0].timestamp if thread.messages else self.start_datetime, reverse=True)
+        return threads[:amount]
+
+    def direct_thread(self, thread_id, amount=20):
+        return self._thread(thread_id, amount)
+
+    def direct_messages(self, thread_id, amount=20):
+        return self._thread(thread_id, amount).messages
+
+    def direct_send(self, text, thread_ids=None, user_ids=None):
+        with self._lock:
+            for thread_id in thread_ids or []:
+                visible = self._advance(thread_id)
+                replied_to = visible[-1] if visible and visible[-1][1].user_id != self.user_id else None
+                self._append(thread_id, self.user_id, text, self.elapsed())
+                self.sent.append({
+                    'thread_id': thread_id,
+                    'text': text,
+                    'latency_s': self.elapsed() - replied_to[0] if replied_to is not None else None,
+                })
+
+    def user_info(self, user_id):
+        return self.user_short(user_id)
+
+    def user_short(self, user_id):
+        for name, pk in self.user_ids.items():
+            if pk == user_id:
+                return ReplayUser(pk, name.replace(' ', '_').lower(), name)
+        raise KeyError(user_id)
@@ -0,0 +1,209 @@
+import re
+import zlib
+import heapq
+from collections import Counter
+
+import numpy as np
+
+WORD_RE = re.compile(r'\w+')
+NON_WORD_RE = re.compile(r'\W+')
+
+# Mersenne prime modulus of the universal hash families below
+_PRIME = (1 << 61) - 1
+
+def normalize_text(text):
+    """Lower cases text and collapses everything that is not a word character into single spaces."""
+    return NON_WORD_RE.sub(' ', text.lower()).strip()
+
+def words(text):
+    """Returns the lower cased words of text."""
+    return WORD_RE.findall(text.lower())
+
+def ngrams(text_words, n=1):
+    """Returns the n-grams of a list of words (see words) as space-joined strings."""
+    if n == 1:
+        return text_words
+    return [' '.join(gram) for gram in zip(*(text_words[i:] for i in range(n)))]
+
+def _hash_strings(strings):
+    """Stable 32-bit hashes (crc32) of strings, unlike hash() which is salted per process."""
+    return np.fromiter((zlib.crc32(string.encode()) for string in strings), dtype=np.uint64, count=len(strings))
+
+def _hash_coefficients(count, seed):
+    rng = np.random.default_rng(seed)
+    return (rng.integers(1, 1 << 32, size=count, dtype=np.uint64),
+            rng.integers(0, 1 << 32, size=count, dtype=np.uint64))
+
+class CountMinSketch:
+    """
+    Approximate counts of an unbounded set of keys in width x depth counters: an estimate is never below
+    the true count and exceeds it by at most 2N/width with probability 1 - 2^-depth (N the total count).
+    """
+    def __init__(self, width=1 << 20, depth=4, seed=0):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self._a, self._b = _hash_coefficients(depth, seed)
+        self.total = 0
+
+    def _columns(self, keys):
+        hashes = _hash_strings(keys)
+        # a*h + b stays below 2^64 for 32-bit a, b and h
+        return (self._a[:, None] * hashes[None, :] + self._b[:, None]) % _PRIME % self.width
+
+    def add_many(self, keys, counts):
+        """Adds counts[i] to keys[i], vectorised over the keys."""
+        if not keys:
+            return
+        counts = np.asarray(counts, dtype=np.int64)
+        for row, columns in enumerate(self._columns(keys)):
+            np.add.at(self.table[row], columns.astype(np.intp), counts)
+        self.total += int(counts.sum())
+
+    def estimate_many(self, keys):
+        if not keys:
+            return np.zeros(0, dtype=np.int64)
+        columns = self._columns(keys).astype(np.intp)
+        return self.table[np.arange(self.depth)[:, None], columns].min(axis=0)
+
+    def estimate(self, key):
+        return int(self.estimate_many([key])[0])
+
+class FrequencySketch:
+    """
+    Streaming top-k of keys (e.g. words or n-grams) in bounded memory.
+    Keys are counted exactly within a buffer of up to buffer_size distinct keys; each full buffer is
+    added to a CountMinSketch, and the k keys with the highest estimates among the previous top-k and
+    the buffered keys are kept as candidates. Memory is O(width*depth + buffer_size + k) however long
+    the stream is; counts of the top keys are the sketch's (over)estimates. The sketch is only allocated
+    when the buffer first fills up: until then counts are exact and cost no table.
+    compact() drops everything but the top k once the stream is over.
+    """
+    def __init__(self, k=100, width=1 << 20, depth=4, buffer_size=100_000, seed=0):
+        self.k = k
+        self.buffer_size = buffer_size
+        self.sketch_options = (width, depth, seed)
+        self.sketch = None
+        self.candidates = {}
+        self.compacted = False
+        self._buffer = Counter()
+
+    def update(self, keys):
+        if self.compacted:
+            raise RuntimeError('A compacted FrequencySketch cannot be updated')
+        self._buffer.update(keys)
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        if self.sketch is None:
+            self.sketch = CountMinSketch(*self.sketch_options)
+        keys = list(self._buffer)
+        self.sketch.add_many(keys, list(self._buffer.values()))
+        self._buffer.clear()
+
+        keys = list(set(keys) | self.candidates.keys())
+        estimates = self.sketch.estimate_many(keys)
+        top = np.argsort(-estimates, kind='stable')[:self.k]
+        self.candidates = {keys[i]: int(estimates[i]) for i in top}
+
+    def compact(self):
+        """Keeps the top k keys only, freeing the sketch and the buffer; no key can be added afterwards."""
+        if self.sketch is None:
+            self.candidates = dict(self._buffer.most_common(self.k))
+            self._buffer.clear()
+        else:
+            self.flush()
+            self.sketch = None
+        self.compacted = True
+
+    def estimate(self, key):
+        if self.compacted:
+            return self.candidates.get(key, 0)
+        if self.sketch is None:
+            return self._buffer[key]
+        self.flush()
+        return self.sketch.estimate(key)
+
+    def most_common(self, n=None):
+        """[(key, count)] of the top min(n, k) keys, most frequent first; counts are estimates once the sketch is used."""
+        n = min(n or self.k, self.k)
+        if self.sketch is None and not self.compacted:
+            return self._buffer.most_common(n)
+        self.flush()
+        return heapq.nlargest(n, self.candidates.items(), key=lambda item: item[1])
+
+class TextStats:
+    """
+    Word n-gram frequencies per participant, accumulated in one pass over any number of messages
+    (see Inbox.text_stats). Each (participant, n) has its own FrequencySketch, which only allocates a
+    count-min table for participants with more than buffer_size distinct n-grams; finish(participant)
+    compacts them to their top k once all of a participant's messages were added.
+    """
+    def __init__(self, ngram_sizes=(1,), k=100, width=1 << 16, depth=4, buffer_size=100_000):
+        self.ngram_sizes = tuple(ngram_sizes)
+        self.sketch_options = dict(k=k, width=width, depth=depth, buffer_size=buffer_size)
+        self.sketches = {}
+        self.message_counts = Counter()
+
+    def add(self, participant, text):
+        self.message_counts[participant] += 1
+        text_words = words(text)
+        for n in self.ngram_sizes:
+            sketch = self.sketches.get((participant, n))
+            if sketch is None:
+                sketch = self.sketches[(participant, n)] = FrequencySketch(**self.sketch_options)
+            sketch.update(ngrams(text_words, n))
+
+    def finish(self, participant):
+        """Keeps only the top k n-grams of participant, who can receive no more messages."""
+        for n in self.ngram_sizes:
+            sketch = self.sketches.get((participant, n))
+            if sketch is not None:
+                sketch.compact()
+
+    def most_common(self, participant, n=1, top=None):
+        sketch = self.sketches.get((participant, n))
+        return sketch.most_common(top) if sketch is not None else []
+
+class NearDuplicateFilter:
+    """
+    Detects near-duplicate texts in one pass with MinHash and locality sensitive hashing.
+    A text is represented by the set of its character shingles (after normalize_text); num_perm hash
+    minima estimate the Jaccard similarity of two such sets, and the signature is split in `bands`
+    bands whose hashes index the texts seen so far. A text is a near duplicate when one of its bands
+    matches a previous text, which happens with high probability above a Jaccard similarity of
+    about (1/bands)^(bands/num_perm) (0.71 by default) and rarely below it. Memory is one int per band
+    per distinct text kept.
+    """
+    def __init__(self, num_perm=128, bands=16, shingle_size=4, seed=0):
+        if num_perm % bands:
+            raise ValueError(f'num_perm ({num_perm}) must be a multiple of bands ({bands})')
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+        self._a, self._b = _hash_coefficients(num_perm, seed)
+        self._buckets = [set() for _ in range(bands)]
+        self.seen = 0
+        self.duplicates = 0
+
+    def signature(self, text):
+        text = normalize_text(text)
+        size = self.shingle_size
+        shingles = list({text[i:i+size] for i in range(max(1, len(text) - size + 1))})
+        hashes = _hash_strings(shingles)
+        return ((self._a[:, None] * hashes[None, :] + self._b[:, None]) % _PRIME).min(axis=1)
+
+    def is_duplicate(self, text, add=True):
+        """Whether text nearly duplicates a text seen before; unless add=False, it is remembered."""
+        self.seen += 1
+        bands = [hash(band.tobytes()) for band in np.split(self.signature(text), self.bands)]
+        duplicate = any(band in buckets for band, buckets in zip(bands, self._buckets))
+        if duplicate:
+            self.duplicates += 1
+        elif add:
+            for band, buckets in zip(bands, self._buckets):
+                buckets.add(band)
+        return duplicate
@@ -0,0 +1,106 @@
+import time
+import sqlite3
+import threading
+from collections import OrderedDict, namedtuple
+
+CachedUser = namedtuple('CachedUser', ['username', 'full_name', 'updated_at'])
+
+class UserCache:
+    """
+    Bounded cache of Instagram user id -> (username, full name), persisted to a SQLite file so a restart
+    does not have to look every participant up again.
+    Entries expire ttl seconds after they were fetched, and at most max_size of them are kept, the least
+    recently used being evicted first (from memory and from the file). Lookups are served from memory;
+    writes go through to the file. It can be shared by the monitors of several threads, across threads.
+    Use path=':memory:' for a cache that is not persisted.
+    """
+    def __init__(self, path='users_cache.sqlite', ttl=7*24*3600, max_size=10_000, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS users ('
+            'user_id TEXT PRIMARY KEY, username TEXT, full_name TEXT, updated_at REAL, last_used REAL)'
+        )
+        self._db.execute('DELETE FROM users WHERE updated_at < ?', (self.clock() - ttl,))
+        rows = self._db.execute(
+            'SELECT user_id, username, full_name, updated_at FROM users ORDER BY last_used DESC LIMIT ?', (max_size,)
+        ).fetchall()
+        # Least recently used first, as in the OrderedDict
+        for user_id, username, full_name, updated_at in reversed(rows):
+            self._entries[user_id] = CachedUser(username, full_name, updated_at)
+        self._db.execute(
+            'DELETE FROM users WHERE user_id NOT IN (SELECT user_id FROM users ORDER BY last_used DESC LIMIT ?)', (max_size,)
+        )
+        self._db.commit()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def _expired(self, entry, now):
+        return now - entry.updated_at > self.ttl
+
+    def get(self, user_id):
+        """Returns the CachedUser of user_id, or None if it is not cached or has expired."""
+        key = str(user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry, self.clock()):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, user_id, username, full_name=None):
+        self.put_many([(user_id, username, full_name)])
+
+    def put_many(self, users):
+        """
+        Stores (user_id, username, full_name) tuples, or objects with pk/username/full_name attributes
+        such as the users of an instagrapi thread. Entries that are already cached unchanged and fresh
+        are only marked as used, so warming the cache from every inbox listing costs no writes.
+        """
+        now = self.clock()
+        rows = []
+        with self._lock:
+            for user in users:
+                user_id, username, full_name = user if isinstance(user, tuple) else (user.pk, user.username, user.full_name)
+                key = str(user_id)
+                entry = self._entries.get(key)
+                if entry is None or self._expired(entry, now) or (entry.username, entry.full_name) != (username, full_name):
+                    self._entries[key] = CachedUser(username, full_name, now)
+                    rows.append((key, username, full_name, now, now))
+                self._entries.move_to_end(key)
+
+            evicted = []
+            while len(self._entries) > self.max_size:
+                evicted.append((self._entries.popitem(last=False)[0],))
+
+            if rows or evicted:
+                self._db.executemany('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?)', rows)
+                self._db.executemany('DELETE FROM users WHERE user_id = ?', evicted)
+                self._db.commit()
+
+    def prefetch(self, threads):
+        """Warms the cache with the participants of instagrapi threads, e.g. those of Client.direct_threads()."""
+        self.put_many(user for thread in threads for user in thread.users)
+
+    def close(self):
+        with self._lock:
+            # Persist the recency order, so the same entries survive the next load
+            now = self.clock()
+            self._db.executemany('UPDATE users SET last_used = ? WHERE user_id = ?',
+                                 [(now + i*1e-6, user_id) for i, user_id in enumerate(self._entries)])
+            self._db.commit()
+            self._db.close()